@@ -7,6 +7,10 @@ from map_targeting_age import *
 from collections import defaultdict, Counter
 import scipy.stats as ss
 import numpy as np
+import pandas as pd
+
+GENDERS = ['male', 'female']
+TARGETING_GENDER_DISTRIBUTIONS = {'All': [0.5, 0.5], 'Women': [0, 1], 'Men': [1, 0]}
 
 def get_targeting_gender_distribution(ad):
     if ad['targeting_gender'] == 'All':
@@ -26,12 +30,8 @@ def get_actual_age_distribution(ad):
     return actual_age_distribution
 
 def get_targeting_age_distribution(ad):
-    mapping = map_age_interval(ad['targeting_age'])
-    total = np.sum([mapping[k] for k in mapping])
-    new_distribution = Counter()
-    for k in mapping:
-        new_distribution[k] = mapping[k]/total
-    return new_distribution
+    weights = age_interval_weights(ad['targeting_age'], normalize=True)
+    return Counter(dict(zip(AGE_BINS, weights)))
 
 def gender_distribution_distance(row):
     x = [row['male'], row['female']]
@@ -54,3 +54,37 @@ def age_distribution_distance(row):
     x = [actual[k] for k in age_bins]
     return ss.wasserstein_distance(x, y)
 
+
+# Vectorized distances over all ads (ads x bins matrices)
+
+# 1-D Wasserstein distance between the values in each row of x and y (same as ss.wasserstein_distance(x[i], y[i]) for every row)
+def wasserstein_distance_rows(x, y):
+    # With equally many, equally weighted values, the integral over |CDF_x - CDF_y| reduces to the mean difference of the sorted values
+    x = np.sort(np.asarray(x, dtype=float), axis=1)
+    y = np.sort(np.asarray(y, dtype=float), axis=1)
+    return np.abs(x - y).mean(axis=1)
+
+def actual_age_matrix(df):
+    return df[AGE_BINS].to_numpy(dtype=float)
+
+def actual_gender_matrix(df):
+    return df[GENDERS].to_numpy(dtype=float)
+
+def targeting_gender_matrix(targeting_gender):
+    # Unknown targeting results in NaN (last row)
+    table = np.array(list(TARGETING_GENDER_DISTRIBUTIONS.values()) + [[np.nan] * len(GENDERS)], dtype=float)
+    codes = pd.Categorical(targeting_gender, categories=list(TARGETING_GENDER_DISTRIBUTIONS)).codes
+    return table[codes]
+
+def targeting_age_matrix(targeting_age):
+    return map_age_intervals(targeting_age, normalize=True)
+
+# Rows of a distribution matrix as dicts/Counters (e.g. for the targeting_age_distribution column)
+def distribution_dicts(matrix, bins, factory=Counter):
+    return [factory(dict(zip(bins, row))) for row in matrix.tolist()]
+
+def gender_distribution_distances(actual_gender, targeting_gender):
+    return wasserstein_distance_rows(actual_gender, targeting_gender)
+
+def age_distribution_distances(actual_age, targeting_age):
+    return wasserstein_distance_rows(actual_age, targeting_age)
@@ -0,0 +1,158 @@
+'''
+Functions to answer common audit questions on the merged data from in-memory indexes instead of full-frame scans:
+bitmaps per party, platform, and targeting category (_use flags), ads sorted by start date, and a cube of impressions,
+spend, flags, and distances pre-aggregated by party, platform, and start week
+
+Example: index = load_index("Data/DE_merged_data")
+         cube_aggregate(index, by=["party", "week"], measures=["spend"])     # spend per party per week
+         share_using(index, "interests_include_use", party="spd")            # share of SPD ads using interests
+         cube_mean(index, "age_distribution_distance", party="afd", platform=1)
+'''
+
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from data_storage import read_table
+
+MEASURES = ["spend", "impressions"]
+DISTANCE_COLUMNS = ["age_distribution_distance", "gender_distribution_distance"]
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# Indexes of the merged data: number of ads, row values of measures and distances, bitmaps (packed bits, one bit per ad)
+# of all ads and per party, platform, and _use flag, ad positions sorted by start date with their dates (ads without start
+# date are left out), and the pre-aggregated cube
+AuditIndex = namedtuple("AuditIndex", ["n_ads", "values", "bitmaps", "date_order", "dates", "cube"])
+
+
+###############################################
+# Indexes
+###############################################
+
+# Bitmap of a boolean mask
+def bitmap(mask):
+    return np.packbits(np.asarray(mask, dtype=bool))
+
+
+# Number of ads in a bitmap
+def count(bits):
+    return int(POPCOUNT[bits].sum(dtype=np.int64))
+
+
+# Positions of the ads in a bitmap
+def positions(bits, n_ads):
+    return np.flatnonzero(np.unpackbits(bits, count=n_ads))
+
+
+# Bitmaps of each value of a column (missing values have no bitmap)
+def value_bitmaps(values):
+    codes, uniques = pd.factorize(values)
+    return {value: bitmap(codes == code) for code, value in enumerate(uniques)}
+
+
+# Cube: number of ads, sums of measures, number of ads using each flag, and sums and counts of distances per party,
+# platform, and start week (Monday)
+def build_cube(df, flags):
+    distances = [c for c in DISTANCE_COLUMNS if c in df.columns]
+    cube = df[["party", "platform"] + MEASURES + flags].copy()
+    cube["week"] = df["ad_delivery_start_time"].dt.to_period("W").dt.start_time
+    cube["n_ads"] = 1
+    for col in distances:
+        cube[col + "_sum"] = df[col].fillna(0)
+        cube[col + "_count"] = df[col].notna().astype(int)
+    cube[flags] = cube[flags].astype(int)
+    return cube.groupby(["party", "platform", "week"], observed=True, dropna=False).sum().reset_index()
+
+
+# Build the indexes of the merged data (compact dtypes, see data_storage.compact_merged_data)
+def build_index(df):
+    df = df.reset_index(drop=True)
+    flags = [c for c in df.columns if c.endswith("_use")]
+    dates = pd.to_datetime(df["ad_delivery_start_time"]).to_numpy()
+    date_order = np.argsort(dates, kind="stable")
+    # NaT is sorted last
+    date_order = date_order[:int((~np.isnat(dates)).sum())]
+    bitmaps = {"all": bitmap(np.ones(len(df), dtype=bool)), "party": value_bitmaps(df["party"]), "platform": value_bitmaps(df["platform"]),
+               "flags": {col: bitmap(df[col].to_numpy() == 1) for col in flags}}
+    values = {col: df[col].to_numpy(dtype=float) for col in MEASURES + [c for c in DISTANCE_COLUMNS if c in df.columns]}
+    return AuditIndex(len(df), values, bitmaps, date_order, dates[date_order], build_cube(df, flags))
+
+
+# Read the merged data (path without file extension, the typed pickle file is read) and build its indexes
+def load_index(path):
+    return build_index(read_table(path, format="pickle"))
+
+
+###############################################
+# Queries
+###############################################
+
+# Bitmap of the ads matching all filters: party, platform (single values or lists), start date in [start, end) (ads
+# without start date never match a date filter), and flags (all _use columns must be used)
+def select(index, party=None, platform=None, start=None, end=None, flags=()):
+    bits = index.bitmaps["all"].copy()
+    for column, values in [("party", party), ("platform", platform)]:
+        if values is None:
+            continue
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        any_value = np.zeros_like(bits)
+        for value in values:
+            any_value |= index.bitmaps[column].get(value, np.zeros_like(bits))
+        bits &= any_value
+    for flag in flags:
+        bits &= index.bitmaps["flags"][flag]
+    if start is not None or end is not None:
+        first = np.searchsorted(index.dates, np.datetime64(pd.Timestamp(start)), side="left") if start is not None else 0
+        last = np.searchsorted(index.dates, np.datetime64(pd.Timestamp(end)), side="left") if end is not None else len(index.dates)
+        in_range = np.zeros(index.n_ads, dtype=bool)
+        in_range[index.date_order[first:last]] = True
+        bits &= bitmap(in_range)
+    return bits
+
+
+# Number of ads matching the filters (see select)
+def count_ads(index, **filters):
+    return count(select(index, **filters))
+
+
+# Share of the ads matching the filters that use a targeting category (_use column)
+def share_using(index, flag, **filters):
+    bits = select(index, **filters)
+    n_ads = count(bits)
+    return count(bits & index.bitmaps["flags"][flag]) / n_ads if n_ads else np.nan
+
+
+# Mean of a measure or distance over the ads matching the filters (missing values are ignored)
+def mean(index, column, **filters):
+    values = index.values[column][positions(select(index, **filters), index.n_ads)]
+    return np.nanmean(values) if np.isfinite(values).any() else np.nan
+
+
+# Filter the cube by party, platform, and start week in [week of start, week of end): half-open at week granularity, so the
+# week of end is excluded even if end is not a Monday (select filters dates exactly)
+def filter_cube(index, party=None, platform=None, start=None, end=None):
+    cube = index.cube
+    mask = np.ones(len(cube), dtype=bool)
+    for column, values in [("party", party), ("platform", platform)]:
+        if values is not None:
+            mask &= cube[column].isin(values if isinstance(values, (list, tuple, set)) else [values]).to_numpy()
+    if start is not None:
+        mask &= (cube["week"] >= pd.Timestamp(start).to_period("W").start_time).to_numpy()
+    if end is not None:
+        mask &= (cube["week"] < pd.Timestamp(end).to_period("W").start_time).to_numpy()
+    return cube[mask]
+
+
+# Sums of measures (default: number of ads, spend, impressions; also <flag> = number of ads using a flag) by party,
+# platform, and/or week from the cube (filters: see filter_cube)
+def cube_aggregate(index, by=("party", "week"), measures=("n_ads",) + tuple(MEASURES), **filters):
+    return filter_cube(index, **filters).groupby(list(by), observed=True)[list(measures)].sum()
+
+
+# Mean of a distance column by party, platform, and/or week (by=() => one value) from the cube
+def cube_mean(index, column, by=(), **filters):
+    cube = filter_cube(index, **filters)
+    if not by:
+        return cube[column + "_sum"].sum() / cube[column + "_count"].sum()
+    sums = cube.groupby(list(by), observed=True)[[column + "_sum", column + "_count"]].sum()
+    return (sums[column + "_sum"] / sums[column + "_count"]).rename(column)
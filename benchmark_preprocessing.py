@@ -0,0 +1,252 @@
+"""
+A script to benchmark the preprocessing of ad library data on synthetic ads.
+
+"python benchmark_preprocessing.py --output results.json" times the main steps of the pipeline at 10k/100k/1M ads (row-wise
+versions only at 10k), "--compare baseline.json" reports the change against an earlier run.
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+from preprocessing_ad_library_DE import expand_demographic_distribution, parse_demographic_distribution, parse_ranges, RANGE_COLUMNS, clean_ad_library, demographic_shares, join_demographics
+from age_gender_distribution_distances import (TARGETING_GENDER_DISTRIBUTIONS, get_targeting_gender_distribution, get_actual_age_distribution,
+                                                get_targeting_age_distribution, gender_distribution_distance, age_distribution_distance,
+                                                actual_gender_matrix, actual_age_matrix, targeting_gender_matrix, targeting_age_matrix,
+                                                gender_distribution_distances, age_distribution_distances)
+from map_targeting_age import map_age_interval, map_age_intervals, age_interval_weights
+from targeting_criteria import parse_targeting, group_targeting_criteria, get_unique_categories, targeting_count_matrix, targeting_criteria_lists
+from synthetic_ads import synthetic_raw_ads, synthetic_targeting
+
+
+# Age and gender buckets reported by the Ad Library (including unknown, unlike the AGE_BINS and GENDERS of the distances)
+DEMOGRAPHIC_AGE_BINS = ['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+', 'Unknown']
+DEMOGRAPHIC_GENDERS = ['female', 'male', 'unknown']
+
+
+# Create synthetic ads with cleaned demographic distribution strings
+def synthetic_demographics(n_ads, seed=42):
+    rng = np.random.default_rng(seed)
+    buckets = [(age, gender) for age in DEMOGRAPHIC_AGE_BINS for gender in DEMOGRAPHIC_GENDERS]
+    n_lines = rng.integers(1, len(buckets) + 1, size=n_ads)
+    distributions = []
+    for n in n_lines:
+        lines = rng.choice(len(buckets), size=n, replace=False)
+        shares = rng.dirichlet(np.ones(n)).round(6)
+        distributions.append("[" + ", ".join("{'percentage': '%s', 'age': '%s', 'gender': '%s'}" % (p, *buckets[b]) for p, b in zip(shares, lines)) + "]")
+    ads_df = pd.DataFrame({
+        "id": rng.integers(10**14, 10**16, size=n_ads),
+        "impressions_lb": rng.choice([0, 1000, 5000, 10000, 50000], size=n_ads).astype(float),
+        "demographic_distribution": distributions,
+    })
+    ads_df["impressions_ub"] = ads_df["impressions_lb"] * 2 - 1
+    # Some ads do not report a demographic distribution
+    ads_df.loc[rng.random(n_ads) < 0.01, "demographic_distribution"] = np.nan
+    # Same cleaning as in preprocessing_ad_library
+    ads_df["demographic_distribution"] = ads_df["demographic_distribution"].replace(r"\[|\]|'", "", regex=True)
+    return ads_df
+
+
+# Create demographics data frame the way preprocessing_ad_library used to
+def expand_demographic_distribution_rowwise(ads_df):
+    demographics = []
+    _ = ads_df.apply(lambda row: demographics.append(expand_demographic_distribution(row)), axis=1)
+    return pd.concat(demographics, sort=False).reset_index(drop=True)
+
+
+# Time a function call
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+# Compare row-wise and vectorized demographics parsing
+def benchmark_demographics(sizes=(80_000, 1_000_000), rowwise_max=None):
+    for n_ads in sizes:
+        ads_df = synthetic_demographics(n_ads)
+        vectorized, t_vectorized = timed(parse_demographic_distribution, ads_df)
+        print(f"{n_ads:>9} ads | parse_demographic_distribution: {t_vectorized:8.2f}s")
+        if rowwise_max is not None and n_ads > rowwise_max:
+            continue
+        rowwise, t_rowwise = timed(expand_demographic_distribution_rowwise, ads_df)
+        pd.testing.assert_frame_equal(vectorized, rowwise)
+        print(f"{n_ads:>9} ads | expand_demographic_distribution: {t_rowwise:8.2f}s (identical output, {t_rowwise / t_vectorized:.0f}x speedup)")
+
+
+# Create synthetic ads with actual and targeted age/gender distributions
+def synthetic_distributions(n_ads, seed=42):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.dirichlet(np.ones(len(DEMOGRAPHIC_AGE_BINS)), size=n_ads), columns=DEMOGRAPHIC_AGE_BINS)
+    df[DEMOGRAPHIC_GENDERS] = rng.dirichlet(np.ones(len(DEMOGRAPHIC_GENDERS)), size=n_ads)
+    df["targeting_gender"] = rng.choice(list(TARGETING_GENDER_DISTRIBUTIONS), size=n_ads)
+    lower = rng.integers(13, 65, size=n_ads)
+    upper = np.minimum(lower + rng.integers(0, 53, size=n_ads), 65)
+    df["targeting_age"] = [f"{l} - {u}" if u < 65 else f"{l} - 65+" for l, u in zip(lower, upper)]
+    return df
+
+
+# Compute distances row by row the way create_DE_data used to
+def distribution_distances_rowwise(df):
+    df = df.copy()
+    df['targeting_gender_distribution'] = [get_targeting_gender_distribution(row) for _, row in df.iterrows()]
+    df['actual_age_distribution'] = [get_actual_age_distribution(row) for _, row in df.iterrows()]
+    df['targeting_age_distribution'] = [get_targeting_age_distribution(row) for _, row in df.iterrows()]
+    gender = df.apply(gender_distribution_distance, axis=1).to_numpy()
+    age = df.apply(age_distribution_distance, axis=1).to_numpy()
+    return gender, age
+
+
+# Compute distances for all ads at once
+def distribution_distances_vectorized(df):
+    gender = gender_distribution_distances(actual_gender_matrix(df), targeting_gender_matrix(df["targeting_gender"]))
+    age = age_distribution_distances(actual_age_matrix(df), targeting_age_matrix(df["targeting_age"]))
+    return gender, age
+
+
+# Compare row-wise (scipy) and vectorized age/gender distribution distances
+def benchmark_distances(sizes=(80_000, 1_000_000), rowwise_max=None):
+    for n_ads in sizes:
+        df = synthetic_distributions(n_ads)
+        vectorized, t_vectorized = timed(distribution_distances_vectorized, df)
+        print(f"{n_ads:>9} ads | vectorized distances: {t_vectorized:8.2f}s")
+        if rowwise_max is not None and n_ads > rowwise_max:
+            continue
+        rowwise, t_rowwise = timed(distribution_distances_rowwise, df)
+        for v, r in zip(vectorized, rowwise):
+            np.testing.assert_allclose(v, r, rtol=1e-12, atol=1e-12)
+        print(f"{n_ads:>9} ads | scipy distances:      {t_rowwise:8.2f}s (identical output, {t_rowwise / t_vectorized:.0f}x speedup)")
+
+
+# Create synthetic ads with spend, estimated audience size, and impressions ranges
+def synthetic_ranges(n_ads, seed=42):
+    rng = np.random.default_rng(seed)
+    ranges = dict()
+    for col in RANGE_COLUMNS:
+        lower = rng.choice([0, 100, 1000, 5000, 10000, 50000, 100000, 1000000], size=n_ads)
+        upper = (lower * 2 + 99).astype(str)
+        lower = lower.astype(str)
+        ranges[col] = np.char.add(np.char.add(np.char.add("{'lower_bound': '", lower), "', 'upper_bound': '"), np.char.add(upper, "'}")).astype(object)
+        # Very large ads only report a lower bound, some ads report nothing
+        open_ended = rng.random(n_ads) < 0.02
+        ranges[col][open_ended] = np.char.add(np.char.add("{'lower_bound': '", lower[open_ended]), "'}")
+        ranges[col][rng.random(n_ads) < 0.01] = np.nan
+    return pd.DataFrame(ranges)
+
+
+# Extract bounds the way preprocessing_ad_library used to (str.extractall per column)
+def parse_ranges_extractall(ads_df):
+    for col, name in RANGE_COLUMNS.items():
+        values = ads_df[col].str.extractall(r"(\d+)").astype(float)
+        lb = values.loc[pd.IndexSlice[:, 0], :].reset_index()
+        ub = values.loc[pd.IndexSlice[:, 1], :].reset_index()
+        ads_df[name + "_lb"] = np.nan
+        ads_df[name + "_ub"] = np.nan
+        ads_df.loc[lb["level_0"], name + "_lb"] = list(lb.iloc[:, 2])
+        ads_df.loc[ub["level_0"], name + "_ub"] = list(ub.iloc[:, 2])
+    return ads_df
+
+
+# Compare extractall and single-pass range parsing
+def benchmark_ranges(sizes=(80_000, 5_000_000)):
+    for n_ads in sizes:
+        ads_df = synthetic_ranges(n_ads)
+        single_pass, t_single_pass = timed(parse_ranges, ads_df.copy())
+        extractall, t_extractall = timed(parse_ranges_extractall, ads_df.copy())
+        pd.testing.assert_frame_equal(single_pass, extractall)
+        print(f"{n_ads:>9} ads | parse_ranges: {t_single_pass:8.2f}s | extractall: {t_extractall:8.2f}s (identical output, {t_extractall / t_single_pass:.1f}x speedup)")
+
+
+# Preprocess raw ads in memory (preprocessing_ad_library without reading and writing files)
+def preprocess_raw_ads(raw):
+    ads_df, demographics_df = clean_ad_library(raw.copy())
+    gender, age = demographic_shares(demographics_df)
+    return join_demographics(ads_df, gender, age)
+
+
+# Ads with cleaned demographic distribution and impressions bounds (input of the demographics parsing)
+def demographics_input(raw):
+    ads_df = parse_ranges(raw[["id", *RANGE_COLUMNS, "demographic_distribution"]].copy())
+    ads_df["demographic_distribution"] = ads_df["demographic_distribution"].replace(r"\[|\]|'", "", regex=True)
+    return ads_df
+
+
+# Extract targeting categories, counts, and criteria lists of include and exclude (without cached parses)
+def extract_targeting_criteria(targeting):
+    parse_targeting.cache_clear()
+    group_targeting_criteria.cache_clear()
+    for var in ["include", "exclude"]:
+        categories = get_unique_categories(targeting, var)
+        targeting_count_matrix(targeting[var], var, categories)
+        targeting_criteria_lists(targeting[var], var, categories)
+
+
+# Map targeting age intervals to the Ad Library bins (without cached intervals)
+def map_targeting_ages(ages):
+    age_interval_weights.cache_clear()
+    return map_age_intervals(ages)
+
+
+# Map targeting age intervals one by one the way the notebook used to
+def map_targeting_ages_rowwise(ages):
+    return [map_age_interval(age) for age in ages]
+
+
+# Time the main steps of the pipeline on synthetic ads of each size (row-wise versions only up to rowwise_max ads)
+def benchmark_suite(sizes=(10_000, 100_000, 1_000_000), rowwise_max=10_000, seed=42):
+    results = []
+    for n_ads in sizes:
+        raw = synthetic_raw_ads(n_ads, seed)
+        targeting, _ = synthetic_targeting(raw["id"], seed)
+        demographics = demographics_input(raw)
+        distributions = synthetic_distributions(n_ads, seed)
+        steps = [
+            ("preprocessing_ad_library", preprocess_raw_ads, raw, False),
+            ("parse_demographic_distribution", parse_demographic_distribution, demographics, False),
+            ("expand_demographic_distribution", expand_demographic_distribution_rowwise, demographics, True),
+            ("extract_targeting_criteria", extract_targeting_criteria, targeting, False),
+            ("distribution_distances", distribution_distances_vectorized, distributions, False),
+            ("distribution_distances_scipy", distribution_distances_rowwise, distributions, True),
+            ("map_age_intervals", map_targeting_ages, targeting["age"], False),
+            ("map_age_interval", map_targeting_ages_rowwise, targeting["age"], True),
+        ]
+        for name, func, data, rowwise in steps:
+            if rowwise and n_ads > rowwise_max:
+                continue
+            _, seconds = timed(func, data)
+            results.append({"benchmark": name, "n_ads": n_ads, "seconds": seconds})
+            print(f"{n_ads:>9} ads | {name:<32}{seconds:8.2f}s")
+    return results
+
+
+# Compare results with an earlier run (ratio > 1 => slower than the baseline)
+def compare_results(results, baseline):
+    baseline = {(r["benchmark"], r["n_ads"]): r["seconds"] for r in baseline}
+    for r in results:
+        before = baseline.get((r["benchmark"], r["n_ads"]))
+        if before is not None:
+            print(f"{r['n_ads']:>9} ads | {r['benchmark']:<32}{before:8.2f}s -> {r['seconds']:8.2f}s ({r['seconds'] / before:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing on synthetic ads.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--rowwise-max", type=int, default=10_000, help="largest size to time row-wise versions at")
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--compare", help="JSON results of an earlier run")
+    parser.add_argument("--parity", action="store_true", help="check old and new implementations for identical output instead")
+    args = parser.parse_args()
+
+    if args.parity:
+        benchmark_demographics(args.sizes, args.rowwise_max)
+        benchmark_distances(args.sizes, args.rowwise_max)
+        benchmark_ranges(args.sizes)
+    else:
+        results = benchmark_suite(args.sizes, args.rowwise_max)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=1)
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                compare_results(results, json.load(f))
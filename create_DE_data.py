@@ -1,17 +1,15 @@
 # Importing libraries
+import argparse
 import pandas as pd
-import git
 import os
-import ast
-from collections import defaultdict
-from germansentiment import SentimentModel
 import sys
 sys.path.append('../analysis/')
 from age_gender_distribution_distances import *
+from data_storage import STORAGE_FORMAT, MAPPED_PARTY_SCHEMA, MERGED_SCHEMA, apply_schema, compact_merged_data, default_data_path, read_table, write_table
+from instrumentation import instrument
+from sentiment_analysis import sentiment_scores
+from targeting_criteria import get_unique_categories, targeting_count_matrix, targeting_criteria_lists, targeting_features_frame
 
-# Getting the Data folder name ---> we might want a config file
-repo = git.Repo('.', search_parent_directories=True).working_tree_dir
-path_data = os.path.join(repo, "Data")
 
 '''
 Custom functions
@@ -20,219 +18,219 @@ Custom functions
 
 # extract targeting categories
 def get_unique_categories_include(data):
-    unique_categories = defaultdict(set)
-    for vals in data['include'].astype(str).unique():
-        vals = eval(bytes(vals, "utf-8").decode("unicode_escape"))
-        if not vals:
-            continue
-        for group in vals:
-            for val in group:
-                key = group[val]
-                unique_categories[key].add(val)
-    return unique_categories
+    return get_unique_categories(data, 'include')
 
 
 def get_unique_categories_exclude(data):
-    unique_categories = defaultdict(set)
-    for vals in data['exclude'].astype(str).unique():
-        vals = eval(bytes(vals, "utf-8").decode("unicode_escape"))
-        if not vals:
-            continue
-        if isinstance(vals, list):  # to handle one exception in DE data
-            for group in vals:
-                for val in group:
-                    key = group[val]
-                    unique_categories[key].add(val)
-        else:
-            group = vals
-            for val in group:
-                key = group[val]
-                unique_categories[key].add(val)
-    return unique_categories
-
-
-# extract targeting criteria
-def extract_targeting_criteria(ad, var):
-    vals = ad[var]
-    vals_conv = eval(bytes(vals, "utf-8").decode("unicode_escape"))
-
-    cat_vals = defaultdict(list)
-
-    if isinstance(vals_conv, list):  # to handle one exception in DE data
-        for group in vals_conv:
-            for val in group:
-                cat = group[val]
-                cat_vals[cat].append(val)
-    else:
-        group = vals_conv
-        for val in group:
-            cat = group[val]
-            cat_vals[cat].append(val)
-
-    for category in cat_vals:
-        colname = category.replace(" ", "_").lower() + "_" + var
-        ad[colname] = cat_vals[category]
-    return ad
+    return get_unique_categories(data, 'exclude')
 
 
-'''
- Read and join data
-'''
+# Print number of rows dropped by a step of the join
+def report_dropped(step, n_before, n_after):
+    print(f"{step}: {n_before} -> {n_after} rows ({n_before - n_after} dropped).")
 
-# Ad library data
-ad_lib = pd.read_csv(os.path.join(path_data, 'Germany/fb_ad_library_mapped_party_DE.csv'), encoding='utf-8', dtype={'id': str})
 
+# Add ids as int64 join key "key" (rows with ids that are not integers cannot be joined and are dropped)
+def with_id_key(df, id_column, name):
+    ids = df[id_column].astype(str).str.strip()
+    valid = ids.str.fullmatch(r"\d+").to_numpy()
+    report_dropped(f"{name} with integer ids", len(df), int(valid.sum()))
+    df = df[valid].copy()
+    df["key"] = ids[valid].astype("int64").to_numpy()
+    return df
 
-# Create country indicator
-ad_lib["country_id"] = "DE"
 
-# Targeting data
-targeting = pd.read_csv(os.path.join(path_data, 'Germany/fb_targeting_DE.csv'), encoding='utf-8', dtype={'archive_id': str})
-targeting_location = pd.read_csv(os.path.join(path_data, 'Germany/fb_targeting_DE_location.csv'), encoding='utf-8', dtype={'archive_id': str})
-targeting = targeting.merge(targeting_location, how='left', left_on='archive_id', right_on='archive_id')
+# Targeting data indexed by sorted int64 keys (location data is joined to the targeting data of the analyzed ads only)
+def read_targeting(path_data, country, country_id, keys):
+    targeting = pd.read_csv(os.path.join(path_data, country, f'fb_targeting_{country_id}.csv'), encoding='utf-8', dtype={'archive_id': str})
+    targeting = with_id_key(targeting, "archive_id", "targeting")
+    n_targeting = len(targeting)
+    targeting = targeting[targeting["key"].isin(keys)]
+    report_dropped("targeting of ads in the analyzed window", n_targeting, len(targeting))
 
-# Join ad library and targeting data
-df = ad_lib.merge(targeting, how='inner', left_on='id', right_on='archive_id')
+    targeting_location = pd.read_csv(os.path.join(path_data, country, f'fb_targeting_{country_id}_location.csv'), encoding='utf-8', dtype={'archive_id': str})
+    targeting_location = with_id_key(targeting_location, "archive_id", "targeting location")
+    targeting_location = targeting_location[targeting_location["key"].isin(keys)].drop(columns="archive_id").set_index("key").sort_index()
+    targeting = targeting.join(targeting_location, on="key", how="left")
+    return targeting.set_index("key").sort_index()
 
-# Filter ads published before 01/07/2021
-df = df[df["ad_delivery_start_time"] >= "2021-07-01"]
 
-'''
- Create additional variables
-'''
+# Read and join ad library and targeting data of a country (folder in path_data, id used in file names)
+# Ads published before start_date are filtered before the joins, so that only ads of the analyzed window are joined
+def read_and_join_data(path_data, country="Germany", country_id="DE", start_date="2021-07-01"):
 
-# Impressions per spending
-df["impressions_per_spending"] = df["impressions"] / df["spend"]
+    # Ad library data
+    ad_lib = read_table(os.path.join(path_data, country, f'fb_ad_library_mapped_party_{country_id}'), schema=MAPPED_PARTY_SCHEMA)
 
-# Ad duration
-df["ad_duration"] = pd.to_datetime(df["ad_delivery_stop_time"]).dt.date - pd.to_datetime(df["ad_delivery_start_time"]).dt.date + pd.Timedelta(days=1)
+    # Filter ads published before start_date (Germany: 01/07/2021)
+    n_ads = len(ad_lib)
+    ad_lib = ad_lib[ad_lib["ad_delivery_start_time"] >= start_date]
+    report_dropped(f"ads published from {start_date}", n_ads, len(ad_lib))
+    ad_lib = with_id_key(ad_lib, "id", "ads")
 
-# Weekday of ad start (Monday = 0, Sunday = 6)
-df["weekday_start"] = pd.to_datetime(df["ad_delivery_start_time"]).dt.weekday
+    # Create country indicator
+    ad_lib["country_id"] = country_id
 
-# Weekday of ad end (Monday = 0, Sunday = 6)
-df["weekday_end"] = pd.to_datetime(df["ad_delivery_stop_time"]).dt.weekday
+    # Targeting data
+    targeting = read_targeting(path_data, country, country_id, ad_lib["key"].unique())
 
+    # Join ad library and targeting data (lookup in the sorted targeting index, order of the ad library is kept)
+    n_ads = len(ad_lib)
+    df = ad_lib.join(targeting, on="key", how="inner").drop(columns="key").reset_index(drop=True)
+    report_dropped("ads with targeting data", n_ads, len(df))
 
-'''
- Preprocess targeting data
-'''
+    ###############################################
+    # Create additional variables
+    ###############################################
 
-# The columns include and exclude contain different targeting categories (e.g., interests, behaviors, employers, etc.)
-# We want to create a column for each category and populate it with the corresponding targeting criteria
+    # Impressions per spending
+    df["impressions_per_spending"] = df["impressions"] / df["spend"]
 
-# # Create a set containing all targeting categories
-unique_categories_include = get_unique_categories_include(df)
-unique_categories_exclude = get_unique_categories_exclude(df)
+    # Ad duration
+    df["ad_duration"] = pd.to_datetime(df["ad_delivery_stop_time"]).dt.date - pd.to_datetime(df["ad_delivery_start_time"]).dt.date + pd.Timedelta(days=1)
 
-# Create column for each targeting category with indicator whether the category was used for targeting
-# Extract targeting criteria for each category
-df = df.apply(lambda x: extract_targeting_criteria(x, "include"), axis=1)
-df = df.apply(lambda x: extract_targeting_criteria(x, "exclude"), axis=1)
+    # Weekday of ad start (Monday = 0, Sunday = 6)
+    df["weekday_start"] = pd.to_datetime(df["ad_delivery_start_time"]).dt.weekday
 
-# df = df.rename(columns={'include':'include_raw', 'exclude':'exclude_raw'})
+    # Weekday of ad end (Monday = 0, Sunday = 6)
+    df["weekday_end"] = pd.to_datetime(df["ad_delivery_stop_time"]).dt.weekday
 
-# filling NaN with False and dropping two weird rows
-df = df[df["spend"].notna()]
-df = df.fillna(False)
+    return df
 
-#df = df.drop("include_location", axis=1)
 
-# Create list of targeting columns
-# targeting_include_columns = [c for c in df.columns if "include" in c and "raw" not in c and "location" not in c]
-# targeting_exclude_columns = [c for c in df.columns if "exclude" in c and "raw" not in c]
-targeting_include_columns = [x.replace(" ", "_").lower() + "_include" for x in list(unique_categories_include.keys())]
-targeting_exclude_columns = [x.replace(" ", "_").lower() + "_exclude" for x in list(unique_categories_exclude.keys())]
-targeting_columns = targeting_include_columns + targeting_exclude_columns
+# Preprocess targeting data
+def create_targeting_variables(df):
 
+    # The columns include and exclude contain different targeting categories (e.g., interests, behaviors, employers, etc.)
+    # We want to create a column for each category and populate it with the corresponding targeting criteria
 
-# Create variables indicating whether targeting criteria have been used and count of criteria used
-for colname in targeting_columns:
-    # Create dummy indicating whether targeting category has been used
-    use = df[colname].apply(lambda x: 1 if x else 0)
-    # Count number of criteria for each ad (only for categories)
-    count = df[colname].apply(lambda x: len(x) if isinstance(x, list) is True else 0)
-    # Create name for use dummy
-    col_use = colname + "_use"
-    # Create name for count column
-    col_count = colname + "_count"
-    # Add columns to dataframe
-    df = pd.concat([df, use.rename(col_use), count.rename(col_count)], axis=1)
+    # # Create a set containing all targeting categories
+    unique_categories_include = get_unique_categories_include(df)
+    unique_categories_exclude = get_unique_categories_exclude(df)
 
-# # Reformat other targeting criteria
-include_other = [c for c in df.columns if c.startswith("include_") and "raw" not in c and "location" not in c]
-exclude_other = [c for c in df.columns if c.startswith("exclude_") and "raw" not in c and "location" not in c]
+    # Create column for each targeting category with indicator whether the category was used for targeting
+    # Extract targeting criteria for each category
+    criteria_include = targeting_criteria_lists(df["include"], "include", unique_categories_include)
+    criteria_exclude = targeting_criteria_lists(df["exclude"], "exclude", unique_categories_exclude)
+    df = pd.concat([df, criteria_include, criteria_exclude], axis=1)
 
-for col in include_other:
-    df[col] = df[col].apply(lambda x: 1 if x is True else 0)
+    # filling NaN with False and dropping two weird rows
+    df = df[df["spend"].notna()]
+    df = df.fillna(False)
 
-for col in exclude_other:
-    df[col] = df[col].apply(lambda x: 1 if x is True else 0)
+    # Count criteria used per targeting category (sparse ads x categories matrices)
+    counts_include, targeting_include_columns = targeting_count_matrix(df["include"], "include", unique_categories_include)
+    counts_exclude, targeting_exclude_columns = targeting_count_matrix(df["exclude"], "exclude", unique_categories_exclude)
+    targeting_columns = targeting_include_columns + targeting_exclude_columns
 
-df["exclude_location"] = [1 if v == 1 else 0 for v in df["exclude_location"]]
+    # Create variables indicating whether targeting criteria have been used and count of criteria used
+    features_include = targeting_features_frame(counts_include, targeting_include_columns, index=df.index)
+    features_exclude = targeting_features_frame(counts_exclude, targeting_exclude_columns, index=df.index)
+    df = pd.concat([df, features_include, features_exclude], axis=1)
 
-exclude_other.append("exclude_location")
+    # # Reformat other targeting criteria
+    include_other = [c for c in df.columns if c.startswith("include_") and "raw" not in c and "location" not in c]
+    exclude_other = [c for c in df.columns if c.startswith("exclude_") and "raw" not in c and "location" not in c]
 
-# Compute total number of targeting criteria used
-targeting_include_count = [x + "_count" for x in targeting_include_columns]
-targeting_exclude_count = [x + "_count" for x in targeting_exclude_columns]
-df["include_count"] = df[targeting_include_count].sum(axis=1)
-df["exclude_count"] = df[targeting_exclude_count].sum(axis=1)
-df["total_count"] = df["include_count"] + df["exclude_count"] + df[include_other].sum(axis=1) + df[exclude_other].sum(axis=1)
+    for col in include_other:
+        df[col] = df[col].apply(lambda x: 1 if x is True else 0)
 
-# Dropping useless columns
-df = df.drop(["ds", "archive_id"], axis=1)
+    for col in exclude_other:
+        df[col] = df[col].apply(lambda x: 1 if x is True else 0)
 
-# Renaming some columns
-df = df.rename(columns={'age': 'targeting_age', 'gender': 'targeting_gender', 'include': 'include_raw', 'exclude': 'exclude_raw'})
+    df["exclude_location"] = [1 if v == 1 else 0 for v in df["exclude_location"]]
 
-# Age/Gender distribution variables
-df['targeting_gender_distribution'] = [get_targeting_gender_distribution(row) for _, row in df.iterrows()]
-df['actual_age_distribution'] = [get_actual_age_distribution(row) for _, row in df.iterrows()]
-df['targeting_age_distribution'] = [get_targeting_age_distribution(row) for _, row in df.iterrows()]
-df['actual_gender_distribution'] = [get_actual_gender_distribution(row) for _, row in df.iterrows()]
-df['gender_distribution_distance'] = df.apply(gender_distribution_distance, axis=1)
-df['age_distribution_distance'] = df.apply(age_distribution_distance, axis=1)
+    exclude_other.append("exclude_location")
 
-''' 
- Sentiment analysis
-'''
+    # Compute total number of targeting criteria used
+    targeting_include_count = [x + "_count" for x in targeting_include_columns]
+    targeting_exclude_count = [x + "_count" for x in targeting_exclude_columns]
+    df["include_count"] = df[targeting_include_count].sum(axis=1)
+    df["exclude_count"] = df[targeting_exclude_count].sum(axis=1)
+    df["total_count"] = df["include_count"] + df["exclude_count"] + df[include_other].sum(axis=1) + df[exclude_other].sum(axis=1)
 
-# Remove ads with no text
-ads_text = df[df["ad_creative_bodies"].notnull()]
+    # Dropping useless columns
+    df = df.drop(["ds", "archive_id"], axis=1)
 
-# Check non-German ads
-ads_text_non_german = ads_text[ads_text["languages"] != "de"]  # 1601 ads => 1.6 % of ads with text
-# Most ads are still German but classified as nan; Some are in Russian, Turkish English, etc. but very few
+    # Renaming some columns
+    df = df.rename(columns={'age': 'targeting_age', 'gender': 'targeting_gender', 'include': 'include_raw', 'exclude': 'exclude_raw'})
 
-model = SentimentModel()
+    return df
 
-# Initialize empty lists to store results
-results = []
 
-# Loop over each input text
-for i in range(len(ads_text)):
-    # Get the input text
-    text = ads_text.iloc[i]["ad_creative_bodies"]
+# Age/Gender distribution distances between targeted and actual audience
+def create_distribution_variables(df):
 
-    # Predict sentiment
-    classes, probabilities = model.predict_sentiment([text], output_probabilities=True)
+    # Age/Gender distributions (ads x bins matrices)
+    targeting_gender = targeting_gender_matrix(df['targeting_gender'])
+    actual_age = actual_age_matrix(df)
+    targeting_age = targeting_age_matrix(df['targeting_age'])
+    actual_gender = actual_gender_matrix(df)
 
-    # Extract the values
-    sentiment_class = classes[0]
-    positive_prob = probabilities[0][0][1]
-    negative_prob = probabilities[0][1][1]
-    neutral_prob = probabilities[0][2][1]
+    # Age/Gender distribution variables
+    df['targeting_gender_distribution'] = distribution_dicts(targeting_gender, GENDERS, factory=dict)
+    df['actual_age_distribution'] = distribution_dicts(actual_age, AGE_BINS)
+    df['targeting_age_distribution'] = distribution_dicts(targeting_age, AGE_BINS)
+    df['actual_gender_distribution'] = distribution_dicts(actual_gender, GENDERS)
+    df['gender_distribution_distance'] = gender_distribution_distances(actual_gender, targeting_gender)
+    df['age_distribution_distance'] = age_distribution_distances(actual_age, targeting_age)
 
-    # Append the results to the list
-    results.append([ads_text.iloc[i]["id"], sentiment_class, positive_prob, negative_prob, neutral_prob])
+    return df
 
-# Create a DataFrame from the list of results
-sentiment = pd.DataFrame(results, columns=['id', 'sentiment_class', 'sentiment_positive', 'sentiment_negative', 'sentiment_neutral'])
 
-# Merge sentiment analysis results with main dataframe
-df = df.merge(sentiment, how='left', left_on='id', right_on='id')
+# Sentiment analysis of ad texts (id and sentiment variables; model_name None => default German model)
+# Texts are scored in batches of batch_size, in n_workers processes if n_workers > 1
+def create_sentiment_variables(df, path_data, country_id="DE", model_name=None, torch_threads=None, batch_size=64, n_workers=1):
+
+    # Remove ads with no text
+    ads_text = df[df["ad_creative_bodies"].notnull()]
+
+    # Score each distinct text once (in batches) and reuse cached scores of earlier runs
+    sentiment_scores_text = sentiment_scores(ads_text["ad_creative_bodies"], batch_size=batch_size, n_workers=n_workers, torch_threads=torch_threads,
+                                             cache_path=os.path.join(path_data, f"{country_id}_sentiment_cache.csv"), model_name=model_name)
+
+    # Create a DataFrame with the results
+    sentiment = pd.concat([ads_text[["id"]], sentiment_scores_text], axis=1)
 
-# Save final dataframe
-df.to_csv(os.path.join(path_data, "DE_merged_data.csv"), encoding='utf-8', index=False)
-df.to_pickle(os.path.join(path_data, "DE_merged_data.pkl"))
+    return sentiment
+
+
+# Merge sentiment analysis results with main dataframe
+def merge_sentiment(df, sentiment):
+    return df.merge(sentiment, how='left', left_on='id', right_on='id')
+
+
+# Save final dataframe (compact dtypes, targeting criteria lists are saved in a separate table <country_id>_targeting_criteria)
+def save_merged_data(df, path_data, country_id="DE"):
+    df, criteria = compact_merged_data(apply_schema(df.copy(), MERGED_SCHEMA))
+    df.to_csv(os.path.join(path_data, f"{country_id}_merged_data.csv"), encoding='utf-8', index=False)
+    df.to_pickle(os.path.join(path_data, f"{country_id}_merged_data.pkl"))
+    criteria.to_pickle(os.path.join(path_data, f"{country_id}_targeting_criteria.pkl"))
+    # Columnar copy (typed, supports memory-mapped reads of selected columns)
+    if STORAGE_FORMAT != "csv":
+        write_table(df, os.path.join(path_data, f"{country_id}_merged_data"))
+        write_table(criteria, os.path.join(path_data, f"{country_id}_targeting_criteria"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge and enrich the German ad library and targeting data.")
+    parser.add_argument("--batch-size", type=int, default=64, help="number of texts scored per batch by the sentiment model")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes scoring sentiment batches")
+    args = parser.parse_args()
+    path_data = default_data_path()
+    with instrument("merge") as record:
+        df = read_and_join_data(path_data)
+        record["rows"] = len(df)
+    with instrument("targeting") as record:
+        df = create_targeting_variables(df)
+        record["rows"] = len(df)
+    with instrument("distances") as record:
+        df = create_distribution_variables(df)
+        record["rows"] = len(df)
+    with instrument("sentiment") as record:
+        sentiment = create_sentiment_variables(df, path_data, batch_size=args.batch_size, n_workers=args.workers)
+        df = merge_sentiment(df, sentiment)
+        record["rows"] = len(sentiment)
+    with instrument("save") as record:
+        save_merged_data(df, path_data)
+        record["rows"] = len(df)
@@ -0,0 +1,64 @@
+'''
+Functions to convert the spend of ads to EUR with date-indexed exchange rate tables (one table per currency)
+'''
+
+import glob
+import os
+import re
+import numpy as np
+import pandas as pd
+
+SPEND_COLUMNS = ["spend", "spend_lb", "spend_ub"]
+# Exchange rate files (Bundesbank format, units of the currency per EUR), e.g. exchange_rate_USDEUR.csv
+RATE_FILE_PATTERN = re.compile(r"exchange_rate_(?P<currency>[A-Z]{3})EUR\.csv$")
+
+
+# Read exchange rates of a currency (sorted by date; days without rate, marked by ".", are dropped)
+def read_exchange_rates(file):
+    rates = pd.read_csv(file, sep=";", header=None, usecols=[0, 1], names=["date", "rate"], dtype=str)
+    rates["date"] = pd.to_datetime(rates["date"], format="%Y-%m-%d", errors="coerce")
+    rates["rate"] = pd.to_numeric(rates["rate"].where(rates["rate"] != ".").str.replace(",", "."), errors="coerce")
+    rates = rates.dropna().drop_duplicates(subset="date", keep="last").sort_values("date")
+    return pd.Series(rates["rate"].to_numpy(), index=pd.DatetimeIndex(rates["date"]), name="rate")
+
+
+# Exchange rate files of all currencies in a folder
+def rate_files(data_folder):
+    return [f for f in sorted(glob.glob(os.path.join(data_folder, "exchange_rate_*EUR.csv"))) if RATE_FILE_PATTERN.search(os.path.basename(f))]
+
+
+# Exchange rate tables of all currencies with a rate file in a folder
+def load_rate_tables(data_folder):
+    rate_tables = dict()
+    for file in rate_files(data_folder):
+        match = RATE_FILE_PATTERN.search(os.path.basename(file))
+        if match:
+            rate_tables[match.group("currency")] = read_exchange_rates(file)
+    return rate_tables
+
+
+# As-of lookup: rate of the last date on or before each date (NaN before the first rate or without date)
+def asof_rates(rates, dates):
+    dates = pd.to_datetime(dates).to_numpy()
+    pos = np.searchsorted(rates.index.to_numpy(), dates, side="right") - 1
+    found = (pos >= 0) & ~pd.isna(dates)
+    return np.where(found, rates.to_numpy()[np.clip(pos, 0, None)], np.nan)
+
+
+# Convert spend columns to EUR with the rate of the last day each ad was active
+# (EUR is unchanged; currencies without rate table and ads without currency get NaN)
+def convert_spend(df, rate_tables, date_column="ad_delivery_stop_time", columns=SPEND_COLUMNS, target="EUR"):
+    currency = df["currency"].to_numpy()
+    rate = np.full(len(df), np.nan)
+    rate[currency == target] = 1.0
+    dates = pd.to_datetime(df[date_column])
+    for cur, rates in rate_tables.items():
+        mask = currency == cur
+        if mask.any():
+            rate[mask] = asof_rates(rates, dates[mask])
+
+    unknown = set(df["currency"].dropna().unique()) - set(rate_tables) - {target}
+    if unknown:
+        print(f"No exchange rates for currencies {sorted(unknown)}, spend of these ads is set to NaN.")
+    df[columns] = df[columns].to_numpy(dtype=float) / rate[:, None]
+    return df
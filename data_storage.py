@@ -0,0 +1,210 @@
+'''
+Functions to store the outputs of the pipeline stages as CSV, Parquet, or Arrow IPC (Feather) files with explicit schemas
+'''
+
+import itertools
+import os
+import numpy as np
+import pandas as pd
+import git
+
+# Storage format of stage outputs: "csv" (default), "parquet", or "feather" (Arrow IPC)
+STORAGE_FORMAT = os.environ.get("STORAGE_FORMAT", "csv")
+FILE_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".arrow", "pickle": ".pkl"}
+
+# Explicit schemas of stage outputs (columns not listed keep the inferred dtype)
+DATE_COLUMNS = ["ad_creation_time", "ad_delivery_start_time", "ad_delivery_stop_time"]
+PREPROCESSED_SCHEMA = {"id": "str", "page_id": "str", **{c: "datetime" for c in DATE_COLUMNS}}
+MAPPED_PARTY_SCHEMA = {**PREPROCESSED_SCHEMA, "party": "str", "candidate_page": "Int64"}
+MERGED_SCHEMA = {**MAPPED_PARTY_SCHEMA, "country_id": "str", "weekday_start": "int", "weekday_end": "int", "ad_duration": "timedelta"}
+# Columns of the merged data stored as categoricals
+CATEGORY_COLUMNS = ["party", "platform", "weekday_start", "weekday_end", "sentiment_class", "targeting_gender", "targeting_age", "country_id",
+                    "currency", "languages", "include_location"]
+
+
+# Data folder of the repository (looked up when needed, not at import; scripts take the Data folder as parameter)
+def default_data_path():
+    repo = git.Repo('.', search_parent_directories=True).working_tree_dir
+    return os.path.join(repo, "Data")
+
+
+# Path of a stage output (path without file extension)
+def table_path(path, format):
+    return path + FILE_EXTENSIONS[format]
+
+
+# Cast columns to the dtypes of a schema
+def apply_schema(df, schema):
+    for col, dtype in schema.items():
+        if col not in df:
+            continue
+        if dtype == "str":
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        elif dtype == "datetime":
+            df[col] = pd.to_datetime(df[col])
+        elif dtype == "timedelta":
+            df[col] = pd.to_timedelta(df[col])
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+# Columnar formats need one type per column => drop False used as missing value in otherwise non-boolean object columns
+def to_arrow_compatible(df):
+    df = df.reset_index(drop=True)
+    for col in df.columns[df.dtypes == object]:
+        is_false = df[col].map(lambda x: x is False)
+        if is_false.any() and not is_false.all():
+            df[col] = df[col].mask(is_false, None)
+    return df
+
+
+# Compact dtypes of the merged data: targeting criteria lists move to a separate table (id, column, criterion),
+# False used as missing value (fillna(False)) becomes NaN again, _use flags are uint8, other integers the smallest integer type,
+# and CATEGORY_COLUMNS categoricals. Dict distribution columns are not stored: the actual distributions are the share columns,
+# the targeting distributions follow from targeting_age and targeting_gender
+def compact_merged_data(df):
+    df = df.reset_index(drop=True)
+    list_columns = [c for c in df.columns[df.dtypes == object] if df[c].map(lambda x: isinstance(x, list)).any()]
+    criteria = criteria_table(df, list_columns)
+    dict_columns = [c for c in df.columns[df.dtypes == object] if df[c].map(lambda x: isinstance(x, dict)).any()]
+    df = df.drop(columns=list_columns + dict_columns)
+
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].mask(df[col].map(lambda x: x is False))
+            if pd.api.types.infer_dtype(df[col], skipna=True) in ["integer", "floating", "mixed-integer-float", "empty"]:
+                df[col] = df[col].astype(float)
+        if col.endswith("_use"):
+            df[col] = df[col].astype(np.uint8)
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    for col in CATEGORY_COLUMNS:
+        if col in df:
+            # Integer categories for numeric columns (e.g. platform 1.0 => 1)
+            values = df[col].astype("Int64") if pd.api.types.is_float_dtype(df[col]) and (df[col].dropna() % 1 == 0).all() else df[col]
+            df[col] = values.astype("category")
+    return df, criteria
+
+
+# Exploded table of targeting criteria lists (one row per ad, criteria column, and criterion)
+def criteria_table(df, list_columns):
+    tables = []
+    for col in list_columns:
+        values = df[col].to_numpy()
+        is_list = np.fromiter((isinstance(v, list) for v in values), dtype=bool, count=len(values))
+        lists = values[is_list]
+        tables.append(pd.DataFrame({
+            "id": np.repeat(df["id"].to_numpy()[is_list], [len(v) for v in lists]),
+            "column": col,
+            "criterion": list(itertools.chain.from_iterable(lists)),
+        }))
+    criteria = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=["id", "column", "criterion"])
+    return criteria.astype({"column": pd.CategoricalDtype(list_columns), "criterion": "category"})
+
+
+# Add criteria list columns of the criteria table to the merged data again (NaN if an ad does not use a category)
+def expand_criteria_lists(df, criteria):
+    df = df.copy()
+    grouped = criteria.groupby(["column", "id"], observed=True)["criterion"].agg(list)
+    for col in criteria["column"].cat.categories:
+        lists = grouped.xs(col, level="column") if col in grouped.index.get_level_values("column") else pd.Series(dtype=object)
+        df[col] = df["id"].map(lists)
+    return df
+
+
+# Write a stage output
+def write_table(df, path, schema=None, format=None):
+    format = format or STORAGE_FORMAT
+    if schema is not None:
+        df = apply_schema(df.copy(), schema)
+    if format == "csv":
+        df.to_csv(table_path(path, format), encoding='utf-8', index=False)
+    elif format == "parquet":
+        to_arrow_compatible(df).to_parquet(table_path(path, format), index=False)
+    elif format == "feather":
+        to_arrow_compatible(df).to_feather(table_path(path, format))
+    elif format == "pickle":
+        df.to_pickle(table_path(path, format))
+    else:
+        raise ValueError(f"Unknown storage format: {format}")
+
+
+# Write a stage output chunk by chunk (chunks: data frames with the same columns) in one or more formats (default:
+# STORAGE_FORMAT); CSV, Parquet, and Arrow IPC files are appended to, a pickle file needs all chunks in memory
+def write_table_chunks(chunks, path, schema=None, formats=None):
+    formats = formats or [STORAGE_FORMAT]
+    writers, pickled = dict(), []
+    n_rows = 0
+    try:
+        for i, df in enumerate(chunks):
+            if schema is not None:
+                df = apply_schema(df.copy(), schema)
+            for format in formats:
+                if format == "csv":
+                    df.to_csv(table_path(path, format), encoding='utf-8', index=False, mode="w" if i == 0 else "a", header=i == 0)
+                elif format in ["parquet", "feather"]:
+                    append_arrow_chunk(writers, df, path, format)
+                elif format == "pickle":
+                    pickled.append(df)
+                else:
+                    raise ValueError(f"Unknown storage format: {format}")
+            n_rows += len(df)
+    finally:
+        for writer, _ in writers.values():
+            writer.close()
+    if pickled:
+        pd.concat(pickled, ignore_index=True).to_pickle(table_path(path, "pickle"))
+    return n_rows
+
+
+# Append a chunk to a Parquet or Arrow IPC file; the column types are those of the first chunk (columns without any
+# value in the first chunk are strings), the writer and schema of each format are kept in writers
+def append_arrow_chunk(writers, df, path, format):
+    # pyarrow is only needed for columnar formats
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    df = to_arrow_compatible(df)
+    if format not in writers:
+        arrow_schema = pa.Schema.from_pandas(df, preserve_index=False)
+        arrow_schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in arrow_schema], metadata=arrow_schema.metadata)
+        file = table_path(path, format)
+        writers[format] = (pq.ParquetWriter(file, arrow_schema) if format == "parquet" else pa.ipc.new_file(file, arrow_schema), arrow_schema)
+    writer, arrow_schema = writers[format]
+    # Columns without any value in this chunk (e.g. float NaN) are converted to the type of the file
+    for field in arrow_schema:
+        if pa.types.is_string(field.type) and df[field.name].isna().all():
+            df[field.name] = pd.Series(None, index=df.index, dtype=object)
+    table = pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=False)
+    writer.write_table(table) if format == "parquet" else writer.write(table)
+
+
+# File and format of a stage output; without format, the first existing file of STORAGE_FORMAT, pickle, csv
+def find_table(path, format=None):
+    if format is None:
+        format = next((f for f in [STORAGE_FORMAT, "pickle", "csv"] if os.path.exists(table_path(path, f))), "csv")
+    return table_path(path, format), format
+
+
+# Read a stage output (only the given columns); without format, see find_table
+def read_table(path, schema=None, columns=None, format=None):
+    file, format = find_table(path, format)
+    if format == "csv":
+        # Read string columns as str (e.g. ids), the remaining schema is applied below
+        dtype = {c: str for c, t in (schema or {}).items() if t == "str"}
+        df = pd.read_csv(file, encoding='utf-8', usecols=columns, dtype=dtype)
+    elif format == "parquet":
+        df = pd.read_parquet(file, columns=columns, memory_map=True)
+    elif format == "feather":
+        # pyarrow is only needed for columnar formats
+        from pyarrow import feather
+        df = feather.read_table(file, columns=columns, memory_map=True).to_pandas()
+    elif format == "pickle":
+        df = pd.read_pickle(file)
+        if columns is not None:
+            df = df[columns]
+    else:
+        raise ValueError(f"Unknown storage format: {format}")
+    if schema is not None:
+        df = apply_schema(df, schema)
+    return df
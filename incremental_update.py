@@ -0,0 +1,183 @@
+"""
+A script to update the preprocessed and merged data with new or changed ads only.
+
+Run "python incremental_update.py preprocessed", then "python mapping_parties_germany.py", then "python incremental_update.py merged".
+"python incremental_update.py check" compares the updated merged data with a full rebuild.
+
+Ads are identified by their id (as in DE_fb_ids.csv). For each stage, a hash of every input row is stored next to
+the output. On an update, only rows whose hash is new or changed are processed and upserted into the stored output;
+ads that disappeared from the input are removed.
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from preprocessing_ad_library_DE import RAW_TEXT_DTYPES, GENDER_COLUMNS, AGE_COLUMNS, clean_ad_library, demographic_shares, join_demographics
+from data_storage import MERGED_SCHEMA, apply_schema, compact_merged_data, default_data_path, expand_criteria_lists
+from create_DE_data import read_and_join_data, create_targeting_variables, create_distribution_variables, create_sentiment_variables, merge_sentiment, save_merged_data
+
+
+###############################################
+# Row hashes and upserts
+###############################################
+
+# Rows are keyed by id => several rows with the same id cannot be told apart
+def check_unique_ids(ids, source):
+    duplicated = pd.Index(ids)[pd.Index(ids).duplicated()].unique()
+    if len(duplicated):
+        raise ValueError(f"{source} has {len(duplicated)} duplicate ids, e.g. {list(duplicated[:5])}.")
+
+
+# Hash of each row as hex string (keyed by id)
+def row_hashes(df, key="id"):
+    hashes = pd.util.hash_pandas_object(df, index=False).map("{:016x}".format)
+    ids = df[key].astype(str).to_numpy()
+    check_unique_ids(ids, "Data")
+    return pd.Series(hashes.to_numpy(), index=ids)
+
+
+# Stored row hashes (empty if there is no file or no output to update)
+def read_hashes(file, output_file):
+    if not os.path.exists(file) or not os.path.exists(output_file):
+        return pd.Series(dtype=str)
+    hashes = pd.read_csv(file, dtype=str)
+    return pd.Series(hashes["row_hash"].to_numpy(), index=hashes["id"].to_numpy())
+
+
+def write_hashes(hashes, file):
+    pd.DataFrame({"id": hashes.index, "row_hash": hashes.to_numpy()}).to_csv(file, index=False)
+
+
+# Ids that are new or changed, and ids that were removed since the stored hashes
+def detect_changes(hashes, stored_hashes):
+    check_unique_ids(hashes.index, "Data")
+    check_unique_ids(stored_hashes.index, "Stored hash file")
+    stored = stored_hashes.reindex(hashes.index)
+    changed = hashes.index[stored.to_numpy() != hashes.to_numpy()]
+    removed = stored_hashes.index.difference(hashes.index)
+    return set(changed), set(removed)
+
+
+# Replace rows of changed ads and remove rows of removed ads; fill(df, col) gives values of columns missing in df
+def upsert(stored_df, delta_df, removed, fill, key="id"):
+    keep = stored_df[~stored_df[key].astype(str).isin(set(delta_df[key].astype(str)) | removed)]
+    keep = fill_missing_columns(keep, [c for c in delta_df.columns if c not in keep.columns], fill)
+    delta_df = fill_missing_columns(delta_df, [c for c in keep.columns if c not in delta_df.columns], fill)
+    return pd.concat([keep, delta_df[keep.columns]], ignore_index=True)
+
+
+def fill_missing_columns(df, columns, fill):
+    if not columns:
+        return df
+    return df.assign(**{c: fill(df, c) for c in columns})
+
+
+# Missing demographic shares: 0 for ads with demographic data, NaN otherwise
+def fill_preprocessed(df, col):
+    shares = [c for c in GENDER_COLUMNS + AGE_COLUMNS if c in df.columns]
+    has_demographics = df[shares].notna().any(axis=1) if shares else pd.Series(False, index=df.index)
+    return np.where(has_demographics, 0.0, np.nan)
+
+
+# Missing targeting variables: not used (0) for _use/_count columns, False (as after fillna(False)) otherwise
+def fill_merged(df, col):
+    return 0 if col.endswith("_use") or col.endswith("_count") else False
+
+
+###############################################
+# Incremental stages
+###############################################
+
+# Preprocess only new or changed raw ads and upsert them into the preprocessed data (path_data: Data folder)
+def update_preprocessed(path_data, country="Germany"):
+    data_folder = os.path.join(path_data, country)
+    output_file = os.path.join(data_folder, "fb_ad_library_preprocessed_DE.csv")
+    hash_file = os.path.join(data_folder, "fb_ad_library_preprocessed_DE_hashes.csv")
+
+    raw = pd.read_csv(os.path.join(data_folder, "fb_ad_library_data_DE.csv"), dtype=RAW_TEXT_DTYPES)
+    hashes = row_hashes(raw)
+    stored_hashes = read_hashes(hash_file, output_file)
+    changed, removed = detect_changes(hashes, stored_hashes)
+    print(f"Preprocessing {len(changed)} new or changed ads, removing {len(removed)} ads.")
+
+    stored = pd.read_csv(output_file) if os.path.exists(output_file) else pd.DataFrame(columns=["id"])
+    delta = raw[raw["id"].astype(str).isin(changed)]
+    if len(delta):
+        ads_df, demographics_df = clean_ad_library(delta.reset_index(drop=True))
+        gender, age = demographic_shares(demographics_df, gender_columns=GENDER_COLUMNS, age_columns=AGE_COLUMNS)
+        delta = join_demographics(ads_df, gender, age)
+    if len(delta) or removed:
+        upsert(stored, delta, removed, fill_preprocessed).to_csv(output_file, sep=",", index=False)
+    write_hashes(hashes, hash_file)
+
+
+# Enrich only new or changed ads (targeting variables, distances, sentiment) and upsert them into the merged data
+def update_merged_data(path_data):
+    merged_file = os.path.join(path_data, "DE_merged_data.pkl")
+    hash_file = os.path.join(path_data, "DE_merged_data_hashes.csv")
+
+    joined = read_and_join_data(path_data)
+    hashes = row_hashes(joined)
+    stored_hashes = read_hashes(hash_file, merged_file)
+    changed, removed = detect_changes(hashes, stored_hashes)
+    print(f"Enriching {len(changed)} new or changed ads, removing {len(removed)} ads.")
+
+    stored = read_merged_data(path_data) if os.path.exists(merged_file) else pd.DataFrame(columns=["id"])
+    delta = joined[joined["id"].astype(str).isin(changed)].copy()
+    if len(delta):
+        delta = create_targeting_variables(delta)
+        delta = create_distribution_variables(delta)
+        delta = merge_sentiment(delta, create_sentiment_variables(delta, path_data))
+    if len(delta) or removed:
+        save_merged_data(upsert(stored, delta, removed, fill_merged), path_data)
+    write_hashes(hashes, hash_file)
+
+
+###############################################
+# Consistency check
+###############################################
+
+# Stored merged data with targeting criteria lists
+def read_merged_data(path_data):
+    df = pd.read_pickle(os.path.join(path_data, "DE_merged_data.pkl"))
+    return expand_criteria_lists(df, pd.read_pickle(os.path.join(path_data, "DE_targeting_criteria.pkl")))
+
+
+# Rebuild the merged data from scratch (without saving, same dtypes as the stored data)
+def rebuild_merged_data(path_data):
+    df = create_targeting_variables(read_and_join_data(path_data))
+    df = create_distribution_variables(df)
+    df = merge_sentiment(df, create_sentiment_variables(df, path_data))
+    return expand_criteria_lists(*compact_merged_data(apply_schema(df, MERGED_SCHEMA)))
+
+
+def is_empty(value):
+    return value is False or value is None or (isinstance(value, (int, float, np.number)) and (value == 0 or np.isnan(value)))
+
+
+# Check that the incrementally updated data equals a full rebuild (same ads and values; columns only present on one
+# side, e.g. targeting categories no ad uses anymore, must be empty)
+def check_consistency(incremental_df, full_df, key="id"):
+    incremental_df = incremental_df.sort_values(key, key=lambda x: x.astype(str)).reset_index(drop=True)
+    full_df = full_df.sort_values(key, key=lambda x: x.astype(str)).reset_index(drop=True)
+    for df, other in [(incremental_df, full_df), (full_df, incremental_df)]:
+        for col in df.columns.difference(other.columns):
+            assert df[col].map(is_empty).all(), f"Column {col} is only present on one side and not empty"
+    columns = [c for c in full_df.columns if c in incremental_df.columns]
+    pd.testing.assert_frame_equal(incremental_df[columns], full_df[columns], check_dtype=False, check_categorical=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update the preprocessed or merged data with new or changed ads only.")
+    parser.add_argument("stage", choices=["preprocessed", "merged", "check"])
+    parser.add_argument("--data", default=None, help="Data folder (default: Data folder of the repository)")
+    args = parser.parse_args()
+    path_data = args.data or default_data_path()
+    if args.stage == "preprocessed":
+        update_preprocessed(path_data, "Germany")
+    elif args.stage == "merged":
+        update_merged_data(path_data)
+    else:
+        check_consistency(read_merged_data(path_data), rebuild_merged_data(path_data))
+        print("Incremental and full rebuild are identical.")
@@ -0,0 +1,109 @@
+'''
+Functions to record wall time, CPU time, memory, and row counts of the stages of the pipeline as JSON
+
+Memory of a stage: resident set size at its start and its increase until its end, and the increase of the process's
+peak resident set size during the stage (0 if the stage stays below the peak of an earlier stage)
+
+Configured with environment variables:
+    INSTRUMENTATION_LOG     file to append the records to as JSON lines
+    INSTRUMENTATION_STDOUT  set to 1 to print the records (default: records are only kept in RECORDS and the log file)
+    PROFILE_STAGES        comma-separated stages to run with cProfile (stats are saved as <stage>.prof)
+    TRACEMALLOC_STAGES    comma-separated stages to trace memory allocations of with tracemalloc
+'''
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+INSTRUMENTATION_LOG = os.environ.get("INSTRUMENTATION_LOG")
+INSTRUMENTATION_STDOUT = os.environ.get("INSTRUMENTATION_STDOUT") == "1"
+PROFILE_STAGES = [s for s in os.environ.get("PROFILE_STAGES", "").split(",") if s]
+TRACEMALLOC_STAGES = [s for s in os.environ.get("TRACEMALLOC_STAGES", "").split(",") if s]
+
+# Records of all stages run in this process
+RECORDS = []
+
+
+# Current resident set size of the process in MB (None if not available, /proc is Linux only)
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Peak resident set size of the process in MB (None if not available)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+# Difference of two memory measurements in MB (None if not available)
+def increase_mb(start, end):
+    return None if start is None or end is None else round(end - start, 1)
+
+
+# Write a record as JSON line to the log file and/or stdout
+def emit(record):
+    line = json.dumps(record, default=str)
+    if INSTRUMENTATION_LOG:
+        with open(INSTRUMENTATION_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    if INSTRUMENTATION_STDOUT:
+        print(line)
+
+
+# Instrument a stage: "with instrument('load') as record: ...; record['rows'] = len(df)"
+@contextmanager
+def instrument(stage):
+    record = {"stage": stage}
+    profiler = cProfile.Profile() if stage in PROFILE_STAGES else None
+    trace = stage in TRACEMALLOC_STAGES and not tracemalloc.is_tracing()
+    if trace:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    start_rss, start_peak_rss = rss_mb(), peak_rss_mb()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record["wall_seconds"] = round(time.perf_counter() - start_wall, 3)
+        record["cpu_seconds"] = round(time.process_time() - start_cpu, 3)
+        record["rss_start_mb"] = None if start_rss is None else round(start_rss, 1)
+        record["rss_increase_mb"] = increase_mb(start_rss, rss_mb())
+        record["peak_rss_increase_mb"] = increase_mb(start_peak_rss, peak_rss_mb())
+        if profiler is not None:
+            profiler.disable()
+            record["profile"] = save_profile(profiler, stage)
+        if trace:
+            record["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            record["top_allocations"] = [str(s) for s in tracemalloc.take_snapshot().statistics("lineno")[:10]]
+            tracemalloc.stop()
+        RECORDS.append(record)
+        emit(record)
+
+
+# Save profile of a stage and print the functions with the largest cumulative time
+def save_profile(profiler, stage, n_functions=20):
+    file = f"{stage}.prof"
+    profiler.dump_stats(file)
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(n_functions)
+    print(output.getvalue())
+    return file
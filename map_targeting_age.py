@@ -3,6 +3,14 @@ A function to map age intervals from the Ad Targeting to the Ad Library data
 Written by (30/06/2023)
 '''
 
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+AGE_BINS = ['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+']
+# Targeting ages range from 13 to 65+
+AGE_MIN, AGE_MAX = 13, 65
+
 # A function to compute overlap between two intervals
 def get_overlap(interval1, interval2):
     """
@@ -53,6 +61,45 @@ def map_age_interval(age_interval_str):
             
     return mapping
 
+# A function to parse an age interval from Targeting data (e.g. '18 - 65+' -> (18, 65))
+def parse_age_interval(age_interval_str):
+    bounds = age_interval_str.replace("+", "").split(" - ")
+    left = int(bounds[0])
+    right = left if len(bounds) == 1 else int(bounds[1])
+    return left, right
+
+# Precompute the bin weights of all age intervals in the targeting range (AGE_MIN..AGE_MAX x AGE_MIN..AGE_MAX x bins)
+def build_age_interval_table():
+    size = AGE_MAX - AGE_MIN + 1
+    table = np.full((size, size, len(AGE_BINS)), np.nan)
+    for left in range(AGE_MIN, AGE_MAX + 1):
+        for right in range(left, AGE_MAX + 1):
+            mapping = map_age_interval(f"{left} - {right}")
+            table[left - AGE_MIN, right - AGE_MIN] = [mapping[k] for k in AGE_BINS]
+    return table
+
+AGE_INTERVAL_TABLE = build_age_interval_table()
+
+# A function to look up the bin weights of an age interval (memoized, labels outside the table are mapped directly)
+@lru_cache(maxsize=None)
+def age_interval_weights(age_interval_str, normalize=False):
+    left, right = parse_age_interval(age_interval_str)
+    if AGE_MIN <= left <= right <= AGE_MAX:
+        weights = AGE_INTERVAL_TABLE[left - AGE_MIN, right - AGE_MIN]
+    else:
+        mapping = map_age_interval(age_interval_str)
+        weights = np.array([mapping[k] for k in AGE_BINS], dtype=float)
+    if normalize:
+        weights = weights / np.sum(weights)
+    return tuple(weights.tolist())
+
+# A function to map a column of age intervals to an ads x bins matrix of (normalized) bin weights
+def map_age_intervals(age_intervals, normalize=True):
+    codes, uniques = pd.factorize(pd.Series(age_intervals))
+    # Missing intervals result in NaN (last row)
+    table = [age_interval_weights(u, normalize) for u in uniques] + [(np.nan,) * len(AGE_BINS)]
+    return np.array(table, dtype=float)[codes]
+
 if __name__ == "__main__":
     example = '15 - 48'
     result = map_age_interval(example)
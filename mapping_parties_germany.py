@@ -0,0 +1,284 @@
+"""
+A script to map ads to parties (Python version of mapping_parties_germany.Rmd).
+
+Party and candidate names are compiled into Aho-Corasick automata so that each distinct sponsor and page name is
+scanned once in linear time instead of being matched against large regex alternations.
+"""
+
+import argparse
+import os
+import re
+from collections import deque, namedtuple
+import numpy as np
+import pandas as pd
+from data_storage import STORAGE_FORMAT, DATE_COLUMNS, PREPROCESSED_SCHEMA, MAPPED_PARTY_SCHEMA, default_data_path, read_table, write_table
+from currency_conversion import load_rate_tables, convert_spend
+
+# Party names
+PARTIES = ["cdu", "csu", "spd", "afd", "fdp", "die linke", "grüne"]
+# Party indicators (later parties take precedence for the party variable)
+PARTY_COLUMNS = ["others", "gruene", "linke", "afd", "fdp", "spd", "union"]
+# Party names and youth organizations added to the candidate names of each party
+PARTY_KEYWORDS = {
+    "union": ["cdu", "csu", "christlich demokratische union deutschlands", "christlich-soziale union", "junge union"],
+    "spd": ["spd", "sozialdemokratische partei deutschlands", "jusos"],
+    "afd": ["afd", "alternative für deutschland", "junge alternative für deutschland", "junge alternative"],
+    "fdp": ["fdp", "freie demokratische partei", "junge liberale"],
+    "linke": ["die linke", "linksjugend", r"\[\'solid\]", "linksfraktion", "fraktion die linke"],
+    "gruene": ["grüne", "bündnis 90/die grünen", "grüne jugend"],
+    "others": ["liberal-konservative jugend", "hintnerjugend", "sozialistische deutsche arbeiterjugend", "junge nationalisten", "junge ökologen",
+               "rebell", "junge freie wähler", "junge piraten", "parteifrei"],
+}
+# Sponsors wrongly identified by the keywords
+INCORRECT_KEYWORDS = ["audible", "1stdibs", "die familienunternehmer", "ministerium für soziales, gesundheit, frauen und familie", "familienbetriebe land und forst",
+                      "deine sport familie", "senatsverwaltung für bildung, jugend und familie", "familienzentrum winsen", "karriere im familienunternehmen",
+                      "niklas schulz", "stiftung familienunternehmen", "familienbäckerei", "stadt- und familienfest bad schwartau", "familienservice lernwelten",
+                      "bundesministerium für familie, senioren, frauen und jugend", "northvolt", "dezvoltare", "ubp - union bancaire privée", "wir lieben altenburg"]
+# Pages of which the party running the ad is not uniquely identifiable
+AMBIGUOUS_PAGES = ["Stadtratsfraktion SPD/Volt München", "Fraktionsgemeinschaft DIE LINKE/Die PARTEI im Chemnitzer Stadtrat"]
+# Keywords with these characters were regex patterns in the R version and are matched as regex
+REGEX_CHARACTERS = set(".^$*+?{}[]\\|()")
+
+# Aho-Corasick automaton: transitions and failure link of each state, labels of keywords ending in each state,
+# and regex patterns of keywords with regex characters (per label)
+KeywordMatcher = namedtuple("KeywordMatcher", ["goto", "fail", "labels", "patterns"])
+
+
+###############################################
+# Keyword matching
+###############################################
+
+# Build a matcher from a dict keyword -> labels
+def build_matcher(keywords):
+    goto, fail, labels = [{}], [0], [set()]
+    regex_keywords = dict()
+    for keyword, keyword_labels in keywords.items():
+        if REGEX_CHARACTERS.intersection(keyword):
+            for label in keyword_labels:
+                regex_keywords.setdefault(label, []).append(keyword)
+            continue
+        state = 0
+        for char in keyword:
+            if char not in goto[state]:
+                goto[state][char] = len(goto)
+                goto.append({})
+                fail.append(0)
+                labels.append(set())
+            state = goto[state][char]
+        labels[state].update(keyword_labels)
+
+    # Failure links in breadth-first order (longest proper suffix that is also a prefix of a keyword)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            f = fail[state]
+            while f and char not in goto[f]:
+                f = fail[f]
+            fail[next_state] = goto[f].get(char, 0)
+            # Keywords ending in the failure state also end in this state
+            labels[next_state] |= labels[fail[next_state]]
+
+    patterns = {label: re.compile("|".join(kws)) for label, kws in regex_keywords.items()}
+    return KeywordMatcher(goto, fail, [frozenset(l) for l in labels], patterns)
+
+
+# Labels of all keywords found in a text (single scan)
+def match_labels(text, matcher):
+    goto, fail, labels = matcher.goto, matcher.fail, matcher.labels
+    found = set()
+    state = 0
+    for char in text:
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+        if labels[state]:
+            found |= labels[state]
+    found.update(label for label, pattern in matcher.patterns.items() if label not in found and pattern.search(text))
+    return found
+
+
+# Labels found in each text of a series (each distinct text is scanned once)
+def match_column(texts, matcher):
+    codes, uniques = pd.factorize(texts)
+    found = pd.Series([match_labels(text, matcher) for text in uniques], dtype=object)
+    return pd.Series(found.take(codes).to_numpy(), index=texts.index)
+
+
+# Indicator columns (0/1) of labels found in each text
+def label_indicators(found, labels):
+    return pd.DataFrame({label: found.map(lambda x: label in x).astype(int) for label in labels}, index=found.index)
+
+
+###############################################
+# Candidates
+###############################################
+
+# Load and preprocess the candidate list btw21 (we will assign party affiliation of ads based on this)
+def read_candidates(file):
+    candidates = pd.read_csv(file, sep=";", dtype=str)
+    candidates = candidates.rename(columns=lambda x: x.replace(",", "") if x.endswith(",,") else x)
+    candidates = candidates.rename(columns={"Nachname": "surname", "Vornamen": "name", "Geburtsjahr": "year_birth", "Gruppenname": "party_off", "GruppennameLang": "party_long"})
+    candidates = candidates[["surname", "name", "year_birth", "party_off", "party_long"]].copy()
+
+    candidates.loc[candidates["party_off"].str.contains("EB: ", na=False), "party_off"] = "parteiunabhängig"
+    candidates.loc[candidates["party_off"].str.contains("parteiunabhängig", na=False), "party_long"] = "parteiunabhängig"
+    candidates.loc[candidates["party_long"].str.contains("bergpartei, die überpartei - ökoanarchistisch-realdadaistisches sammelbecken", na=False), "party_off"] = "bergpartei"
+    candidates.loc[candidates["party_long"].str.contains("Die Urbane", na=False), "party_off"] = "Die Urbane"
+    candidates.loc[candidates["party_off"].str.contains("CSU", na=False), "party_long"] = "Christilich-Soziale Union"
+    candidates["surname"] = candidates["surname"].str.replace("ǧ", "g", regex=False)
+    candidates["name_long"] = candidates["name"] + " " + candidates["surname"]
+    candidates["name_short"] = candidates["name"].str.extract(r"([^\W\d_]+)", expand=False) + " " + candidates["surname"]
+    candidates["name_alt"] = candidates["name"].str.extract(r"((?:[^\W\d_]|-)+)", expand=False) + " " + candidates["surname"]
+    for col in ["party_off", "party_long", "name_long", "name_short", "name_alt"]:
+        candidates[col] = candidates[col].str.lower()
+
+    party_off = candidates["party_off"]
+    candidates["party"] = np.select(
+        [party_off.str.contains("cdu|csu", na=False), party_off.str.contains("die linke", na=False), party_off.str.contains("grüne", na=False),
+         ~party_off.str.contains("union|linke|spd|fdp|gruene|afd", na=True)],
+        ["union", "linke", "gruene", "others"], default=None)
+    candidates["party"] = candidates["party"].fillna(party_off)
+    return candidates.drop_duplicates(subset=["name_long", "party", "year_birth"])
+
+
+# Unique non-missing values of columns
+def unique_values(df, columns):
+    return list(dict.fromkeys(v for col in columns for v in df[col] if isinstance(v, str)))
+
+
+# Keywords (candidate names, party names, and youth organizations) of each party
+def party_keywords(candidates):
+    keywords = dict()
+    for party, extra in PARTY_KEYWORDS.items():
+        if party == "others":
+            names = unique_values(candidates[~candidates["party_off"].isin(PARTIES)], ["name_long", "name_short", "name_alt", "party_off", "party_long"])
+        else:
+            names = unique_values(candidates[candidates["party"] == party], ["name_long", "name_short", "name_alt"])
+        for keyword in names + extra:
+            keywords.setdefault(keyword, set()).add(party)
+    return keywords
+
+
+###############################################
+# Mapping
+###############################################
+
+# Read preprocessed ads (path without file extension, see read_table; strings are trimmed as by readr's read_csv in the
+# R version)
+def read_preprocessed(path):
+    df = read_table(path, schema=PREPROCESSED_SCHEMA)
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].str.strip().replace("", np.nan)
+    return df
+
+
+# Reset party indicators of sponsors matching several parties (manual corrections)
+def correct_duplicates(fb, flags):
+    sponsor = fb["sponsor"]
+    page_name = fb["page_name"]
+
+    def reset(mask, keep):
+        flags.loc[mask.to_numpy(), [c for c in PARTY_COLUMNS if c not in keep]] = 0
+
+    reset(sponsor.str.contains("cdu|csu"), ["union"])
+    reset(sponsor.str.contains("spd |spd-"), ["spd"])
+    reset(sponsor.str.contains("afd|junge alternative"), ["afd"])
+    reset(sponsor.str.contains("die partei "), ["others"])
+    reset(sponsor.str.contains("fdp"), ["fdp"])
+    reset(sponsor.str.contains("linke"), ["linke"])
+    reset(sponsor == "moritz alexander müller ; moritz müller", ["gruene"])
+    others = (sponsor.isin(["jens zimmermann ; jens zimmermann", "jürgen braun mdb ; jürgen braun, mdb", "alexander müller mdb ; alexander müller", "stefan müller ; stefan müller"])
+              | page_name.isin(["Michael Müller", "Andreas Schwarz", "Susanne Mittag", "Die Grünen und Unabhängigen in Reutlingen"]))
+    flags.loc[others.to_numpy(), "others"] = 0
+    flags.loc[sponsor.str.contains("philipp josef erich albrecht").to_numpy(), "afd"] = 0
+    flags.loc[(sponsor == "spd nordfriesland ; jens peter jensen").to_numpy(), "fdp"] = 0
+    flags.loc[sponsor.isin(["tobias grünert ; cdu-vechelde", "stefan schmidt ; stefan schmidt - bürgermeister der stadt annaburg"]).to_numpy(), "gruene"] = 0
+    flags.loc[(page_name == "Martin Reichardt").to_numpy(), "spd"] = 0
+    return flags
+
+
+# Filter ads of parties and candidates and create categorical variable of party
+def map_parties(df_fb, candidates):
+    # Concatenate bylines and page_name, reformat and remove distorting words
+    sponsor = df_fb["bylines"].fillna("NA") + " ; " + df_fb["page_name"].fillna("NA")
+    sponsor = sponsor.str.lower().str.replace("wahlkreis|photovoltaik|tnt", "", n=1, regex=True)
+
+    # Map ad to party and filter by if at least one keyword appeared (i.e. party/candidate names)
+    flags = label_indicators(match_column(sponsor, build_matcher(party_keywords(candidates))), PARTY_COLUMNS)
+    mapped = flags.sum(axis=1) > 0
+    fb = df_fb[mapped].assign(sponsor=sponsor[mapped].str.replace("wahlkreis", "", n=1, regex=False))
+    flags = correct_duplicates(fb, flags[mapped].copy())
+
+    # Delete observations as not uniquely identifiable which party runs ad
+    keep = fb["page_name"].notna() & ~fb["page_name"].isin(AMBIGUOUS_PAGES)
+    duplicates = (flags[keep].sum(axis=1) > 1).sum()
+    if duplicates:
+        print(f"{duplicates} ads are still mapped to several parties.")
+
+    # Some keywords wrongly identify sponsors which we also have to remove manually
+    incorrect = match_column(fb["sponsor"], build_matcher({keyword: {"incorrect"} for keyword in INCORRECT_KEYWORDS})).map(bool)
+    keep &= ~incorrect
+    fb, flags = fb[keep].drop(columns="sponsor"), flags[keep]
+
+    # Create categorical variable of party (later parties take precedence)
+    fb["party"] = np.select([flags[c] == 1 for c in reversed(PARTY_COLUMNS)], list(reversed(PARTY_COLUMNS)), default=None)
+    return fb
+
+
+# Check weather page name is by a candidate
+def candidate_pages(page_names, candidates):
+    matcher = build_matcher({name: {"candidate"} for name in unique_values(candidates, ["name_long", "name_short", "name_alt"])})
+    return match_column(page_names, matcher).map(bool).astype(int)
+
+
+# data_folder: folder of the German data (default: Data/Germany of the repository)
+def mapping_parties_germany(data_folder=None):
+    data_folder = data_folder or os.path.join(default_data_path(), "Germany")
+    print("Reading preprocessed ads and candidates.")
+    df_fb = read_preprocessed(os.path.join(data_folder, "fb_ad_library_preprocessed_DE"))
+    candidates = read_candidates(os.path.join(data_folder, "btw21_kandidaturen_utf8.csv"))
+
+    print("Mapping ads to parties.")
+    fb = map_parties(df_fb, candidates)
+    # Convert spend for ads payed in other currencies (e.g. USD)
+    fb = convert_spend(fb, load_rate_tables(data_folder))
+    fb["page_name"] = fb["page_name"].str.lower()
+    fb["candidate_page"] = candidate_pages(fb["page_name"], candidates)
+
+    # Save mapped ad library data and ad ids in separate file
+    print(f"Saving {len(fb)} mapped ads.")
+    output_path = os.path.join(data_folder, "fb_ad_library_mapped_party_DE")
+    write_table(fb, output_path, format="csv")
+    if STORAGE_FORMAT != "csv":
+        write_table(fb, output_path, schema=MAPPED_PARTY_SCHEMA)
+    write_table(fb[["id"]], os.path.join(data_folder, "fb_ids_DE"), format="csv")
+    return fb
+
+
+# Parity check of the mapped data with the output of mapping_parties_germany.Rmd
+def check_parity(python_file, r_file):
+    frames = []
+    for file in [python_file, r_file]:
+        df = pd.read_csv(file, dtype={"id": str, "page_id": str})
+        for col in DATE_COLUMNS:
+            if col in df:
+                df[col] = pd.to_datetime(df[col], utc=True)
+        frames.append(df.sort_values("id").reset_index(drop=True))
+    python_df, r_df = frames
+    assert list(python_df.columns) == list(r_df.columns), f"Different columns: {set(python_df.columns) ^ set(r_df.columns)}"
+    assert python_df["id"].equals(r_df["id"]), f"Different ads: {len(set(python_df['id']) ^ set(r_df['id']))} ads only mapped by one version"
+    pd.testing.assert_frame_equal(python_df, r_df, check_dtype=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map ads to parties.")
+    parser.add_argument("--check", metavar="R_OUTPUT", help="compare the mapped data with the output of mapping_parties_germany.Rmd")
+    parser.add_argument("--data", default=None, help="folder of the German data (default: Data/Germany of the repository)")
+    args = parser.parse_args()
+    data_folder = args.data or os.path.join(default_data_path(), "Germany")
+    mapping_parties_germany(data_folder)
+    if args.check:
+        check_parity(os.path.join(data_folder, "fb_ad_library_mapped_party_DE.csv"), args.check)
+        print("Python and R party mapping are identical.")
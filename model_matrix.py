@@ -0,0 +1,170 @@
+'''
+Functions to build the model matrix of the regression analysis (dummies, continuous variables, dependent variable) once
+as sparse matrix and to cache it on disk, keyed by the hash of the dataset, the variable specification, and this code
+'''
+
+import hashlib
+import inspect
+import json
+import os
+import sys
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from data_storage import find_table, read_table
+from map_targeting_age import AGE_BINS, map_age_intervals
+
+# Variable specification: dependent variable, parties not analyzed, top 10 targeting categories, other categorical
+# and continuous variables (targeting and age variables are selected from the columns of the data)
+MODEL_SPEC = {
+    "dv": "impressions_per_spending",
+    "exclude_parties": ["others"],
+    "top10_targeting": ["interests_exclude_use", "interests_include_use", "employers_exclude_use", "exclude_location", "behaviors_exclude_use",
+                        "include_lookalike", "exclude_custom_audience", "include_custom_audience", "behaviors_include_use", "exclude_lookalike"],
+    "cat_others": ["party", "candidate_page", "platform", "weekday_start", "weekday_end", "sentiment_class", "targeting_gender"],
+    "cont_others": ["ad_duration", "include_count", "exclude_count"],
+}
+
+# Model matrix: X (sparse CSR, ads x columns: continuous variables and dummies), y (dependent variable), column names,
+# ids of the ads, and variables (dv and lists cat_targeting, cat_others, cont_others, age_targeting_vars, top10_targeting)
+ModelMatrix = namedtuple("ModelMatrix", ["X", "y", "columns", "ids", "variables"])
+
+
+###############################################
+# Feature engineering
+###############################################
+
+# Targeting age distribution per ad (share of the targeted age interval in each age bin)
+def targeting_age_frame(targeting_age, index):
+    df_age = pd.DataFrame(map_age_intervals(targeting_age), index=index)
+    df_age.columns = ["targeting_" + c.replace("-", "_").replace("+", "") for c in AGE_BINS]
+    return df_age
+
+
+# Select and prepare the model variables (ads of excluded parties and ads with missing values are dropped)
+def model_data(df, spec=MODEL_SPEC):
+    df = df.loc[~df["party"].isin(spec["exclude_parties"])].set_index("id")
+    df["ad_duration"] = df["ad_duration"].dt.days.astype("int16")
+    df = df.dropna(axis=1, how="all")
+    df = pd.concat([df, targeting_age_frame(df["targeting_age"], df.index)], axis=1)
+
+    # Targeting variables: used include/exclude categories, other targeting (lookalike, custom audience, location, etc.)
+    # and number of criteria used (total counts are continuous variables)
+    include_targeting_use = [c for c in df.columns if c.endswith("include_use")]
+    exclude_targeting_use = [c for c in df.columns if c.endswith("exclude_use")]
+    include_other = [c for c in df.columns if c.startswith("include") and "raw" not in c and "location" not in c and not c.endswith("_count")]
+    exclude_other = [c for c in df.columns if c.startswith("exclude") and "raw" not in c and not c.endswith("_count")]
+    df["include_count"] = df[[c for c in df.columns if c.endswith("include_count") and c != "include_count"]].sum(axis=1)
+    df["exclude_count"] = df[[c for c in df.columns if c.endswith("exclude_count") and c != "exclude_count"]].sum(axis=1)
+    df[exclude_other] = df[exclude_other].fillna(0).astype(int)
+
+    age_targeting_vars = [c for c in df.columns if c.startswith("targeting_") and "17" not in c and "gender" not in c and "age" not in c]
+    variables = {
+        "dv": spec["dv"],
+        "cat_targeting": include_targeting_use + exclude_targeting_use + include_other + exclude_other,
+        "cat_others": list(spec["cat_others"]),
+        "cont_others": age_targeting_vars + list(spec["cont_others"]),
+        "age_targeting_vars": age_targeting_vars,
+        "top10_targeting": list(spec["top10_targeting"]),
+    }
+
+    # Drop ads with missing values (including infinite DV of ads without spend) and variables without variation
+    df[spec["dv"]] = df[spec["dv"]].replace([np.inf, -np.inf], np.nan)
+    check_vars = variables["cat_targeting"] + variables["cat_others"] + variables["cont_others"] + [spec["dv"]]
+    n_ads = len(df)
+    df = df[check_vars].dropna()
+    print(f"Dropped {n_ads - len(df)} ads with missing values.")
+    no_variation = df.columns[df.nunique() == 1].tolist()
+    print(f"Columns with only one unique value: {no_variation}")
+    df = df.drop(columns=no_variation)
+    for name in ["cat_targeting", "cat_others", "cont_others", "age_targeting_vars"]:
+        variables[name] = [c for c in variables[name] if c not in no_variation]
+    return df, variables
+
+
+# Dummies of a variable as sparse matrix (one column per observed value, in the order of pd.get_dummies)
+def dummies(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.remove_unused_categories()
+    # 0/1 flags stored as floats => dummies named _0/_1 (not _0.0/_1.0)
+    elif values.dtype.kind == "f" and (values == values.round()).all():
+        values = values.astype(int)
+    values = pd.Categorical(values)
+    n = len(values)
+    matrix = sparse.csr_matrix((np.ones(n), (np.arange(n), values.codes)), shape=(n, len(values.categories)))
+    return matrix, list(values.categories)
+
+
+# Build the model matrix of prepared model data (continuous variables first, then the dummies of categorical variables)
+def build_model_matrix(df, variables):
+    blocks = [sparse.csr_matrix(df[variables["cont_others"]].to_numpy(dtype=float))]
+    columns = list(variables["cont_others"])
+    for col in variables["cat_targeting"] + variables["cat_others"]:
+        matrix, categories = dummies(df[col])
+        blocks.append(matrix)
+        columns += [f"{col}_{c}" for c in categories]
+    return ModelMatrix(sparse.hstack(blocks, format="csr"), df[variables["dv"]].to_numpy(dtype=float), columns, df.index.astype(str).tolist(), variables)
+
+
+###############################################
+# Cache
+###############################################
+
+# Hash of the dataset file, the variable specification, and the code building the model matrix
+def model_matrix_key(file, spec):
+    sha256 = hashlib.sha256(json.dumps(spec, sort_keys=True).encode("utf-8"))
+    sha256.update(inspect.getsource(sys.modules[__name__]).encode("utf-8"))
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()[:16]
+
+
+# The metadata file is written last, so that an interrupted write is not read as a complete cache entry
+def write_model_matrix(matrix, cache):
+    sparse.save_npz(cache + "_X.npz", matrix.X)
+    np.save(cache + "_y.npy", matrix.y)
+    with open(cache + ".json", "w", encoding="utf-8") as f:
+        json.dump({"columns": matrix.columns, "ids": matrix.ids, "variables": matrix.variables}, f)
+
+
+def read_model_matrix(cache):
+    with open(cache + ".json", encoding="utf-8") as f:
+        meta = json.load(f)
+    return ModelMatrix(sparse.load_npz(cache + "_X.npz").tocsr(), np.load(cache + "_y.npy"), meta["columns"], meta["ids"], meta["variables"])
+
+
+# Model matrix of a dataset (path without file extension, the typed pickle file is read); read from the cache folder
+# (default: model_matrix next to the dataset) unless the dataset, the specification, or this code changed
+def model_matrix(path, spec=MODEL_SPEC, cache_folder=None):
+    file, format = find_table(path, "pickle")
+    cache_folder = cache_folder or os.path.join(os.path.dirname(file), "model_matrix")
+    cache = os.path.join(cache_folder, "model_matrix_" + model_matrix_key(file, spec))
+    if os.path.exists(cache + ".json"):
+        print(f"Reading cached model matrix {cache}.")
+        return read_model_matrix(cache)
+
+    df, variables = model_data(read_table(path, format=format), spec)
+    matrix = build_model_matrix(df, variables)
+    os.makedirs(cache_folder, exist_ok=True)
+    write_model_matrix(matrix, cache)
+    return matrix
+
+
+###############################################
+# Model inputs
+###############################################
+
+# Columns of the model matrix as sparse matrix (RandomForestRegressor and XGBRegressor accept sparse inputs)
+def select_columns(matrix, columns):
+    position = {c: i for i, c in enumerate(matrix.columns)}
+    return matrix.X[:, [position[c] for c in columns]]
+
+
+# Model matrix (or some of its columns) as dense DataFrame with the dependent variable, e.g. for statsmodels formulas
+def model_frame(matrix, columns=None):
+    columns = list(matrix.columns) if columns is None else list(columns)
+    df = pd.DataFrame(select_columns(matrix, columns).toarray(), columns=columns, index=pd.Index(matrix.ids, name="id"))
+    df[matrix.variables["dv"]] = matrix.y
+    return df
@@ -0,0 +1,146 @@
+"""
+A script to preprocess, merge, and enrich the ad library data of several countries in parallel (one process per country).
+
+Each country has its own configuration (data folder, id used in file names, election date, start of the observation
+period, sentiment model). A failing country does not stop the others: failures are reported with their traceback.
+The merged data of all countries that succeeded is combined into one table (merged_data_countries.pkl, targeting
+criteria in targeting_criteria_countries.pkl), the status of each country is saved in country_runs.csv.
+
+Run "python multi_country_pipeline.py Germany ..." (default: all configured countries); more countries can be
+configured in a JSON file (list of objects with the fields of CountryConfig) with --config.
+"""
+
+import argparse
+import json
+import os
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from preprocessing_ad_library_DE import preprocessing_ad_library
+from mapping_parties_germany import mapping_parties_germany
+from data_storage import CATEGORY_COLUMNS, default_data_path
+from create_DE_data import read_and_join_data, create_targeting_variables, create_distribution_variables, create_sentiment_variables, merge_sentiment, save_merged_data
+
+# Configuration of a country: folder in the Data folder, id used in file names (e.g. fb_ad_library_data_DE.csv),
+# election date, first start date of ads, sentiment model (Hugging Face model name, None => default German model)
+CountryConfig = namedtuple("CountryConfig", ["country", "country_id", "election_date", "start_date", "sentiment_model"])
+
+COUNTRIES = {
+    "Germany": CountryConfig("Germany", "DE", "2021-09-26", "2021-07-01", None),
+}
+
+# Party mapping per country id (countries without mapping need a mapped party file fb_ad_library_mapped_party_<id>.csv)
+PARTY_MAPPINGS = {
+    "DE": mapping_parties_germany,
+}
+
+
+# Read additional country configurations from a JSON file
+def read_country_configs(file):
+    with open(file, encoding="utf-8") as f:
+        return {c["country"]: CountryConfig(**c) for c in json.load(f)}
+
+
+###############################################
+# Country runs
+###############################################
+
+# Run all stages of a country (in a worker process; chunksize: chunked preprocessing, see preprocessing_ad_library);
+# exceptions are returned in the summary, not raised
+def run_country(config, path_data, torch_threads=None, chunksize=None):
+    summary = {"country": config.country, "country_id": config.country_id, "status": "ok", "rows": 0, "error": None}
+    start = time.perf_counter()
+    try:
+        preprocessing_ad_library(config.country, chunksize=chunksize, country_id=config.country_id, election_date=config.election_date, path_data=path_data)
+        if config.country_id in PARTY_MAPPINGS:
+            PARTY_MAPPINGS[config.country_id](os.path.join(path_data, config.country))
+
+        df = read_and_join_data(path_data, config.country, config.country_id, config.start_date)
+        df = create_targeting_variables(df)
+        df = create_distribution_variables(df)
+        sentiment = create_sentiment_variables(df, path_data, config.country_id, model_name=config.sentiment_model, torch_threads=torch_threads)
+        df = merge_sentiment(df, sentiment)
+        save_merged_data(df, path_data, config.country_id)
+        summary["rows"] = len(df)
+    except Exception:
+        summary["status"] = "failed"
+        summary["error"] = traceback.format_exc()
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+# Run countries concurrently (n_workers processes, default: one per country up to the number of cores)
+# path_data: Data folder (default: Data folder of the repository)
+def run_countries(configs, n_workers=None, path_data=None, chunksize=None):
+    path_data = path_data or default_data_path()
+    n_workers = min(len(configs), n_workers or os.cpu_count())
+    # Share the cores between the sentiment models of the workers
+    torch_threads = max(1, os.cpu_count() // n_workers)
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(run_country, config, path_data, torch_threads, chunksize): config for config in configs}
+        for future in as_completed(futures):
+            config = futures[future]
+            try:
+                summary = future.result()
+            # The worker process died (e.g. out of memory)
+            except Exception as e:
+                summary = {"country": config.country, "country_id": config.country_id, "status": "failed", "rows": 0, "error": repr(e), "seconds": None}
+            print(f"{summary['country']}: {summary['status']}.")
+            summaries.append(summary)
+
+    summaries = pd.DataFrame(summaries, columns=["country", "country_id", "status", "rows", "seconds", "error"])
+    summaries.to_csv(os.path.join(path_data, "country_runs.csv"), index=False)
+    succeeded = summaries.loc[summaries["status"] == "ok", "country_id"].tolist()
+    if succeeded:
+        combine_merged_data(succeeded, path_data)
+    print_report(summaries)
+    return summaries
+
+
+###############################################
+# Combined output
+###############################################
+
+# Combine the merged data and targeting criteria of countries (categories are unified across countries)
+def combine_merged_data(country_ids, path_data):
+    df = pd.concat([pd.read_pickle(os.path.join(path_data, f"{c}_merged_data.pkl")) for c in sorted(country_ids)], ignore_index=True)
+    criteria = pd.concat([pd.read_pickle(os.path.join(path_data, f"{c}_targeting_criteria.pkl")) for c in sorted(country_ids)], ignore_index=True)
+    for col in [c for c in CATEGORY_COLUMNS if c in df.columns]:
+        df[col] = df[col].astype("category")
+    criteria = criteria.astype({"column": "category", "criterion": "category"})
+    df.to_pickle(os.path.join(path_data, "merged_data_countries.pkl"))
+    criteria.to_pickle(os.path.join(path_data, "targeting_criteria_countries.pkl"))
+    return df, criteria
+
+
+# Print status of each country and tracebacks of failed countries
+def print_report(summaries):
+    print(f"{'country':<15}{'status':<10}{'rows':>10}{'seconds':>10}")
+    for s in summaries.itertuples():
+        print(f"{s.country:<15}{s.status:<10}{s.rows:>10}{s.seconds if pd.notna(s.seconds) else float('nan'):>10.1f}")
+    for s in summaries[summaries["status"] == "failed"].itertuples():
+        print(f"\n{s.country} failed:\n{s.error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess, merge, and enrich the ad library data of several countries in parallel.")
+    parser.add_argument("countries", nargs="*", help="countries to run (default: all configured countries)")
+    parser.add_argument("--config", help="JSON file with additional country configurations")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per country up to the number of cores)")
+    parser.add_argument("--chunksize", type=int, default=None, help="preprocess the raw data in chunks of this many ads (limits peak memory)")
+    parser.add_argument("--data", default=None, help="Data folder (default: Data folder of the repository)")
+    args = parser.parse_args()
+
+    countries = dict(COUNTRIES)
+    if args.config:
+        countries.update(read_country_configs(args.config))
+    unknown = [c for c in args.countries if c not in countries]
+    if unknown:
+        parser.error(f"no configuration for {unknown}")
+    summaries = run_countries([countries[c] for c in args.countries or countries], n_workers=args.workers, path_data=args.data, chunksize=args.chunksize)
+    if (summaries["status"] == "failed").any():
+        raise SystemExit(1)
@@ -0,0 +1,215 @@
+"""
+A script to run the data pipeline and skip stages whose outputs are up to date.
+
+Each stage declares its input and output files. A stage is run again only if the hash of its inputs
+(file contents) and code (stage function and the modules it uses) changed since its last run or if an output is missing.
+"""
+
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+from collections import namedtuple
+import pandas as pd
+from preprocessing_ad_library_DE import preprocessing_ad_library
+from mapping_parties_germany import mapping_parties_germany
+from currency_conversion import rate_files
+from data_storage import default_data_path
+from instrumentation import instrument
+from create_DE_data import read_and_join_data, create_targeting_variables, create_distribution_variables, create_sentiment_variables, merge_sentiment, save_merged_data
+
+# Folder of the scripts (code files of stages are relative to this folder)
+path_code = os.path.dirname(os.path.abspath(__file__))
+
+# A stage of the pipeline: function run(inputs, outputs), input/output files, and code it depends on (files or functions;
+# modules with helper functions are listed as files, so that changed helpers are detected)
+Stage = namedtuple("Stage", ["name", "run", "inputs", "outputs", "code"])
+STAGE_NAMES = ["preprocess", "party_mapping", "merge", "targeting", "distances", "sentiment", "save"]
+
+
+###############################################
+# Stages
+###############################################
+
+# Stage functions get the Data folder as first argument (bound in pipeline_stages)
+def run_preprocess(path_data, inputs, outputs, chunksize=None):
+    preprocessing_ad_library("Germany", chunksize=chunksize, path_data=path_data)
+
+
+def run_party_mapping(path_data, inputs, outputs):
+    mapping_parties_germany(os.path.join(path_data, "Germany"))
+
+
+def run_merge(path_data, inputs, outputs):
+    read_and_join_data(path_data).to_pickle(outputs[0])
+
+
+def run_targeting(path_data, inputs, outputs):
+    create_targeting_variables(pd.read_pickle(inputs[0])).to_pickle(outputs[0])
+
+
+def run_distances(path_data, inputs, outputs):
+    create_distribution_variables(pd.read_pickle(inputs[0])).to_pickle(outputs[0])
+
+
+def run_sentiment(path_data, inputs, outputs, batch_size=64, n_workers=1):
+    create_sentiment_variables(pd.read_pickle(inputs[0]), path_data, batch_size=batch_size, n_workers=n_workers).to_pickle(outputs[0])
+
+
+def run_save(path_data, inputs, outputs):
+    save_merged_data(merge_sentiment(pd.read_pickle(inputs[0]), pd.read_pickle(inputs[1])), path_data)
+
+
+# Folder of the intermediate stage outputs, the pipeline state, and the timings
+def stages_path(path_data):
+    return os.path.join(path_data, "pipeline")
+
+
+# Stages of the pipeline for a Data folder (chunksize: chunked preprocessing, see preprocessing_ad_library; batch_size,
+# n_workers: sentiment scoring, see create_sentiment_variables; options do not change the outputs and are not part of
+# the stage hashes)
+def pipeline_stages(path_data, chunksize=None, batch_size=64, n_workers=1):
+    def data(*parts):
+        return os.path.join(path_data, *parts)
+
+    def stage_file(name):
+        return os.path.join(stages_path(path_data), name)
+
+    def run(func, **options):
+        return functools.partial(func, path_data, **options)
+
+    return [
+        Stage("preprocess", run(run_preprocess, chunksize=chunksize),
+              [data("Germany", "fb_ad_library_data_DE.csv")],
+              [data("Germany", "fb_ad_library_preprocessed_DE.csv")],
+              ["preprocessing_ad_library_DE.py", "data_storage.py", "instrumentation.py"]),
+        Stage("party_mapping", run(run_party_mapping),
+              [data("Germany", "fb_ad_library_preprocessed_DE.csv"), data("Germany", "btw21_kandidaturen_utf8.csv")] + rate_files(data("Germany")),
+              [data("Germany", "fb_ad_library_mapped_party_DE.csv")],
+              ["mapping_parties_germany.py", "currency_conversion.py", "data_storage.py"]),
+        Stage("merge", run(run_merge),
+              [data("Germany", "fb_ad_library_mapped_party_DE.csv"), data("Germany", "fb_targeting_DE.csv"), data("Germany", "fb_targeting_DE_location.csv")],
+              [stage_file("DE_merged_ads.pkl")],
+              ["create_DE_data.py", "data_storage.py", "instrumentation.py"]),
+        Stage("targeting", run(run_targeting),
+              [stage_file("DE_merged_ads.pkl")],
+              [stage_file("DE_targeting.pkl")],
+              ["create_DE_data.py", "targeting_criteria.py", "instrumentation.py"]),
+        Stage("distances", run(run_distances),
+              [stage_file("DE_targeting.pkl")],
+              [stage_file("DE_distances.pkl")],
+              ["create_DE_data.py", "age_gender_distribution_distances.py", "map_targeting_age.py", "instrumentation.py"]),
+        Stage("sentiment", run(run_sentiment, batch_size=batch_size, n_workers=n_workers),
+              [stage_file("DE_targeting.pkl")],
+              [stage_file("DE_sentiment.pkl")],
+              ["create_DE_data.py", "sentiment_analysis.py", "instrumentation.py"]),
+        Stage("save", run(run_save),
+              [stage_file("DE_distances.pkl"), stage_file("DE_sentiment.pkl")],
+              [data("DE_merged_data.csv"), data("DE_merged_data.pkl"), data("DE_targeting_criteria.pkl")],
+              ["create_DE_data.py", "data_storage.py", "instrumentation.py"]),
+    ]
+
+
+###############################################
+# Hashing
+###############################################
+
+# Hash of a file's content (reused while size and modification time are unchanged)
+def file_hash(path, file_hashes):
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+        return cached["sha256"]
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    file_hashes[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256.hexdigest()}
+    return sha256.hexdigest()
+
+
+# Hash of a stage's inputs and code
+def stage_hash(stage, file_hashes):
+    sha256 = hashlib.sha256(stage.name.encode("utf-8"))
+    for func in [stage.run] + [c for c in stage.code if callable(c)]:
+        # Source of the function, not of the partial binding the Data folder
+        sha256.update(inspect.getsource(func.func if isinstance(func, functools.partial) else func).encode("utf-8"))
+    for path in stage.inputs + [os.path.join(path_code, c) for c in stage.code if not callable(c)]:
+        sha256.update(os.path.basename(path).encode("utf-8"))
+        sha256.update(file_hash(path, file_hashes).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+###############################################
+# Runner
+###############################################
+
+def read_state(state_file):
+    if not os.path.exists(state_file):
+        return {"stages": {}, "files": {}}
+    with open(state_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_state(state, state_file):
+    with open(state_file, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1)
+
+
+# Run all stages in order, skip stages that are up to date (force => run these stages anyway)
+# path_data: Data folder (default: Data folder of the repository), stages: default pipeline_stages(path_data)
+def run_pipeline(path_data=None, stages=None, force=()):
+    path_data = path_data or default_data_path()
+    stages = stages or pipeline_stages(path_data)
+    state_file = os.path.join(stages_path(path_data), "pipeline_state.json")
+    os.makedirs(stages_path(path_data), exist_ok=True)
+    state = read_state(state_file)
+    timings = []
+
+    for stage in stages:
+        missing = [path for path in stage.inputs if not os.path.exists(path)]
+        if missing:
+            raise FileNotFoundError(f"Stage {stage.name}: missing inputs {missing}")
+
+        digest = stage_hash(stage, state["files"])
+        up_to_date = state["stages"].get(stage.name) == digest and all(os.path.exists(path) for path in stage.outputs)
+        if up_to_date and stage.name not in force:
+            print(f"Skipping {stage.name} (up to date).")
+            timings.append({"stage": stage.name, "status": "skipped", "seconds": 0.0})
+            continue
+
+        print(f"Running {stage.name}.")
+        with instrument(stage.name) as record:
+            stage.run(stage.inputs, stage.outputs)
+        timings.append({**record, "status": "ran", "seconds": record["wall_seconds"]})
+
+        # Save state after each stage so that an interrupted run resumes at the failed stage
+        state["stages"][stage.name] = digest
+        write_state(state, state_file)
+
+    print_timings(timings)
+    with open(os.path.join(stages_path(path_data), "pipeline_timings.json"), "w", encoding="utf-8") as f:
+        json.dump(timings, f, indent=1)
+    return timings
+
+
+# Print timing report
+def print_timings(timings):
+    print(f"{'stage':<15}{'status':<10}{'seconds':>10}")
+    for t in timings:
+        print(f"{t['stage']:<15}{t['status']:<10}{t['seconds']:>10.1f}")
+    print(f"{'total':<25}{sum(t['seconds'] for t in timings):>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data pipeline and skip stages that are up to date.")
+    parser.add_argument("--force", nargs="*", default=[], choices=STAGE_NAMES, help="stages to run even if they are up to date")
+    parser.add_argument("--data", default=None, help="Data folder (default: Data folder of the repository)")
+    parser.add_argument("--chunksize", type=int, default=None, help="preprocess the raw data in chunks of this many ads (limits peak memory)")
+    parser.add_argument("--batch-size", type=int, default=64, help="number of texts scored per batch by the sentiment model")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes scoring sentiment batches")
+    args = parser.parse_args()
+    path_data = args.data or default_data_path()
+    run_pipeline(path_data, pipeline_stages(path_data, chunksize=args.chunksize, batch_size=args.batch_size, n_workers=args.workers), force=args.force)
@@ -2,11 +2,37 @@
 A script to preprocess raw ad library data.
 """
 
+import argparse
 import pandas as pd
 import numpy as np
 from functools import reduce
-import git
 import os
+import re
+from data_storage import STORAGE_FORMAT, PREPROCESSED_SCHEMA, default_data_path, write_table, write_table_chunks
+from instrumentation import instrument
+
+# Raw text columns (read as str so that chunks without any value keep the string dtype)
+RAW_TEXT_DTYPES = {c: str for c in ["ad_creative_bodies", "ad_creative_link_captions", "ad_creative_link_titles", "languages", "publisher_platforms",
+                                    "ad_creative_link_descriptions", "spend", "estimated_audience_size", "impressions", "demographic_distribution"]}
+# Range columns of the raw data and names of their lower/upper bound columns
+RANGE_COLUMNS = {"spend": "spend", "estimated_audience_size": "audience", "impressions": "impressions"}
+RANGE_PATTERN = re.compile(r"^\D*(?P<lb>\d+)(?:\D+(?P<ub>\d+))?")
+# Gender and age share columns reported by the Ad Library
+GENDER_COLUMNS = ["automated_ads_gender", "female", "male", "unknown_gender"]
+AGE_COLUMNS = ["13-17", "18-24", "25-34", "35-44", "45-54", "55-64", "65+", "automated_ads_age", "unknown_age"]
+
+
+# Extract lower and upper bounds of range columns (e.g. "{'lower_bound': '100', 'upper_bound': '199'}") in one pass
+# Open-ended ranges (e.g. "{'lower_bound': '1000000'}") have no upper bound (NaN)
+def parse_ranges(ads_df, columns=RANGE_COLUMNS):
+    # Stack all range columns and extract the first two numbers of each value
+    values = pd.concat([ads_df[col] for col in columns], ignore_index=True)
+    bounds = values.str.extract(RANGE_PATTERN).astype(float).to_numpy()
+    bounds = bounds.reshape(len(columns), len(ads_df), 2)
+    for i, col in enumerate(columns.values()):
+        ads_df[col + "_lb"] = bounds[i, :, 0]
+        ads_df[col + "_ub"] = bounds[i, :, 1]
+    return ads_df
 
 
 # Create data frame which shows demographic distribution of each ad
@@ -38,19 +64,39 @@ def expand_demographic_distribution(row):
     return df
 
 
-# Preprocess ad library data
-def preprocessing_ad_library(country):
+# Create demographics data frame for all ads at once (same output as expand_demographic_distribution + pd.concat)
+def parse_demographic_distribution(ads_df):
+    columns = ["percentage", "age", "gender", "id", "impressions_lb", "impressions_ub"]
+    # Only ads with demographic distribution contribute lines
+    ads = ads_df.loc[ads_df["demographic_distribution"].map(type) == str, ["id", "impressions_lb", "impressions_ub", "demographic_distribution"]].reset_index(drop=True)
+    if ads.empty:
+        return pd.DataFrame(columns=columns)
+    # Split values by age, gender (one line per age/gender bucket, index points to the ad)
+    dta = ads["demographic_distribution"].str.split("},").explode()
+    dta = dta.str.replace(r"\{|\}", "", regex=True)
+    # Create percentage, age, and gender variables
+    parts = dta.str.split(",", n=2, expand=True)
+    df = pd.DataFrame({
+        # Extract percentage floats
+        "percentage": parts[0].str.replace("percentage: ", "", regex=False).astype(float).to_numpy(),
+        # Extract age and gender categories, remove trailing whitespace
+        "age": parts[1].str.replace("age: ", "", regex=False).str.rstrip().to_numpy(),
+        "gender": parts[2].str.replace("gender: ", "", regex=False).str.rstrip().to_numpy(),
+    })
+    # Add ad id and compute impressions for each line
+    df["id"] = ads["id"].loc[dta.index].to_numpy()
+    df["impressions_lb"] = df["percentage"] * ads["impressions_lb"].loc[dta.index].to_numpy()
+    df["impressions_ub"] = df["percentage"] * ads["impressions_ub"].loc[dta.index].to_numpy()
+    return df[columns]
+
+
+# Clean raw ad library data (row-wise operations only, can be applied to chunks of the raw data)
+def clean_ad_library(ads_df, election_date="2021-09-26"):
 
-    repo = git.Repo('.', search_parent_directories=True).working_tree_dir
-    data_folder = os.path.join(repo, "Data", country) 
-    
     ###############################################
     # Load raw library data and preprocess
     ###############################################
-    
-    print("Reading raw ad library data.")
-    # Clean data
-    ads_df = pd.read_csv(os.path.join(data_folder, "fb_ad_library_data_DE"+".csv"))
+
     # Drop index
     if "Unnamed: 0" in ads_df:                      
         ads_df = ads_df.drop(columns="Unnamed: 0")
@@ -73,44 +119,18 @@ def preprocessing_ad_library(country):
     ads_df.loc[ads_df["publisher_platforms"].str.contains("facebook") == True, "facebook"] = 1
     ads_df.loc[ads_df["publisher_platforms"].str.contains("instagram") == True, "instagram"] = 1
 
-    # Clean spending
-    spend = ads_df["spend"].str.extractall(r"(\d+)").astype(float)
-    spend_lb = spend.loc[pd.IndexSlice[:, 0], :].reset_index()
-    spend_ub = spend.loc[pd.IndexSlice[:, 1], :].reset_index()
-
-    ads_df["spend_lb"] = np.nan
-    ads_df["spend_ub"] = np.nan
-    ads_df.loc[spend_lb["level_0"], "spend_lb"] = list(spend_lb.iloc[:, 2])
-    ads_df.loc[spend_ub["level_0"], "spend_ub"] = list(spend_ub.iloc[:, 2])
-
-    # Clean estimated audience size
-    audience = ads_df["estimated_audience_size"].str.extractall(r"(\d+)").astype(float)
-    audience_lb = audience.loc[pd.IndexSlice[:, 0], :].reset_index()
-    audience_ub = audience.loc[pd.IndexSlice[:, 1], :].reset_index()
-
-    ads_df["audience_lb"] = np.nan
-    ads_df["audience_ub"] = np.nan
-    ads_df.loc[audience_lb["level_0"], "audience_lb"] = list(audience_lb.iloc[:, 2])
-    ads_df.loc[audience_ub["level_0"], "audience_ub"] = list(audience_ub.iloc[:, 2])
-
-    # Clean number of impressions
-    impressions = ads_df["impressions"].str.extractall(r"(\d+)").astype(float)
-    impressions_lb = impressions.loc[pd.IndexSlice[:, 0], :].reset_index()
-    impressions_ub = impressions.loc[pd.IndexSlice[:, 1], :].reset_index()
-
-    ads_df["impressions_lb"] = np.nan
-    ads_df["impressions_ub"] = np.nan
-    ads_df.loc[impressions_lb["level_0"], "impressions_lb"] = list(impressions_lb.iloc[:, 2])
-    ads_df.loc[impressions_ub["level_0"], "impressions_ub"] = list(impressions_ub.iloc[:, 2])
+    # Clean spending, estimated audience size, and number of impressions
+    with instrument("parse_ranges") as record:
+        ads_df = parse_ranges(ads_df)
+        record["rows"] = len(ads_df)
 
     # Clean demographic distribution
     ads_df["demographic_distribution"] = ads_df["demographic_distribution"].replace("\[|\]|'", "", regex=True)
 
     # Clean demographics and create extra dataframe
-    print("Creating demographics data frame.")
-    demographics = []
-    _ = ads_df.apply(lambda row: demographics.append(expand_demographic_distribution(row)), axis=1)
-    demographics_df = pd.concat(demographics, sort=False).reset_index(drop=True)
+    with instrument("parse_demographics") as record:
+        demographics_df = parse_demographic_distribution(ads_df)
+        record["rows"] = len(demographics_df)
 
     # Drop unformulated columns and save final data
     ads_df = ads_df.drop(columns=["delivery_by_region", "demographic_distribution", "estimated_audience_size", "impressions", "publisher_platforms", "spend"])
@@ -119,11 +139,6 @@ def preprocessing_ad_library(country):
     # Filter library data and reformat
     ###############################################
     
-    print("Final preprocessing to create dataframe.")
-
-    # Election date
-    election_date = "2021-09-26"
-
     # Some ads are active after the election date => we have to adjust the number of impressions, audience size, spend
     # For ads without end date, set end data to start date
     ads_df.loc[ads_df.ad_delivery_stop_time.isna(), "ad_delivery_stop_time"] = ads_df.ad_delivery_start_time
@@ -156,6 +171,12 @@ def preprocessing_ad_library(country):
     # Drop unnecessary columns
     ads_df = ads_df.drop(columns=["ad_creative_link_captions", "ad_creative_link_titles", "ad_snapshot_url", "ad_creative_link_descriptions", "days_before_election", "days_total", "ad_active"])
 
+    return ads_df, demographics_df
+
+
+# Compute gender and age shares per ad (optionally with a fixed set of columns, e.g. for chunks)
+def demographic_shares(demographics_df, gender_columns=None, age_columns=None):
+
     ###############################################
     # Preprocess demographic data
     ###############################################
@@ -175,25 +196,98 @@ def preprocessing_ad_library(country):
     age = age.rename(columns=lambda x: x.strip())
     age = age.rename(columns={"All (Automated App Ads)": "automated_ads_age", "Unknown": "unknown_age"})
 
-    ###############################################
-    # Join ads and demographic data
-    ###############################################
+    # Use fixed columns (categories missing in this data => share of 0)
+    if gender_columns is not None:
+        gender = reindex_shares(gender, gender_columns)
+    if age_columns is not None:
+        age = reindex_shares(age, age_columns)
+
+    return gender, age
 
+
+# Reindex share data frame to fixed columns
+def reindex_shares(shares, columns):
+    unexpected = [c for c in shares.columns if c != "id" and c not in columns]
+    if unexpected:
+        raise ValueError(f"Unexpected demographic categories: {unexpected}")
+    return shares.reindex(columns=["id"] + columns, fill_value=0)
+
+
+# Join ads and demographic data
+def join_demographics(ads_df, gender, age):
     data_frames = [ads_df, gender, age]
+    return reduce(lambda left, right: pd.merge(left, right, on="id", how="left"), data_frames)
 
-    final_df = reduce(lambda left, right: pd.merge(left, right, on="id", how="left"), data_frames)
 
-    # Save preprocessed ad library data
-    print("Saving final dataframe.")
-    final_df.to_csv(os.path.join(data_folder, "fb_ad_library_preprocessed_DE"+".csv"), sep=",", index=False)
+# Preprocess ad library data (chunksize => stream raw data in chunks and append each preprocessed chunk to the output file)
+# country is the folder in path_data (default: Data folder of the repository), country_id is used in the file names
+def preprocessing_ad_library(country, chunksize=None, country_id="DE", election_date="2021-09-26", path_data=None):
 
+    path_data = path_data or default_data_path()
+    data_folder = os.path.join(path_data, country)
+    raw_file = os.path.join(data_folder, f"fb_ad_library_data_{country_id}.csv")
+    output_file = os.path.join(data_folder, f"fb_ad_library_preprocessed_{country_id}.csv")
 
+    if chunksize is not None:
+        preprocessing_ad_library_chunked(raw_file, output_file, chunksize, election_date)
+        return
+
+    print("Reading raw ad library data.")
+    with instrument("load") as record:
+        ads_df = pd.read_csv(raw_file, dtype=RAW_TEXT_DTYPES)
+        record["rows"] = len(ads_df)
+
+    print("Creating demographics data frame.")
+    with instrument("clean_ad_library") as record:
+        ads_df, demographics_df = clean_ad_library(ads_df, election_date)
+        record["rows"] = len(ads_df)
+
+    print("Final preprocessing to create dataframe.")
+    with instrument("join_demographics") as record:
+        gender, age = demographic_shares(demographics_df)
+        final_df = join_demographics(ads_df, gender, age)
+        record["rows"] = len(final_df)
+
+    # Save preprocessed ad library data (CSV file for the R version of the party mapping, typed copy in STORAGE_FORMAT)
+    print("Saving final dataframe.")
+    with instrument("save") as record:
+        write_table(final_df, os.path.splitext(output_file)[0], format="csv")
+        if STORAGE_FORMAT != "csv":
+            write_table(final_df, os.path.splitext(output_file)[0], schema=PREPROCESSED_SCHEMA)
+        record["rows"] = len(final_df)
+
+
+# Preprocessed chunks of the raw data (all chunks have the columns of the first chunk)
+def preprocessed_chunks(raw_file, chunksize, election_date="2021-09-26"):
+    n_ads = 0
+    columns = None
+    for chunk in pd.read_csv(raw_file, dtype=RAW_TEXT_DTYPES, chunksize=chunksize):
+        with instrument("chunk") as record:
+            ads_df, demographics_df = clean_ad_library(chunk, election_date)
+            gender, age = demographic_shares(demographics_df, gender_columns=GENDER_COLUMNS, age_columns=AGE_COLUMNS)
+            final_df = join_demographics(ads_df, gender, age)
+            if columns is None:
+                columns = list(final_df.columns)
+            record["rows"] = len(final_df)
+        n_ads += len(final_df)
+        print(f"Preprocessed {n_ads} ads.")
+        yield final_df[columns]
+
+
+# Preprocess ad library data chunk by chunk (peak memory depends on chunksize, not on the size of the raw data); the
+# CSV file and the columnar copy (STORAGE_FORMAT) are written as in preprocessing_ad_library
+def preprocessing_ad_library_chunked(raw_file, output_file, chunksize, election_date="2021-09-26"):
+    formats = ["csv"] + ([STORAGE_FORMAT] if STORAGE_FORMAT != "csv" else [])
+    write_table_chunks(preprocessed_chunks(raw_file, chunksize, election_date), os.path.splitext(output_file)[0], schema=PREPROCESSED_SCHEMA, formats=formats)
+
+
+# Several countries in parallel: see multi_country_pipeline.py
 if __name__=="__main__":
-    for country in ["Germany"]:
-        try:
-            preprocessing_ad_library(country)
-        except Exception as e:
-            print(e)
+    parser = argparse.ArgumentParser(description="Preprocess the raw ad library data.")
+    parser.add_argument("--chunksize", type=int, default=None, help="preprocess the raw data in chunks of this many ads (limits peak memory)")
+    parser.add_argument("--data", default=None, help="Data folder (default: Data folder of the repository)")
+    args = parser.parse_args()
+    preprocessing_ad_library("Germany", chunksize=args.chunksize, path_data=args.data)
 
 
 
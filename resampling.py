@@ -0,0 +1,184 @@
+'''
+Functions to run bootstrap resamples and cross-validation folds of the efficiency regressions in a process pool
+
+The model matrix is copied once into shared memory and read by all workers (no copy per worker). Each resample gets its
+own seed derived from one seed, so results do not depend on the number of workers or the order in which they finish.
+Results are appended to a checkpoint file as they finish; a restarted run skips the resamples already in the file.
+'''
+
+import copy
+import functools
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from model_matrix import select_columns
+
+# Arrays of the model matrix in shared memory of a worker process (X as CSR matrix, y)
+_shared = None
+
+
+###############################################
+# Shared memory
+###############################################
+
+# Copy arrays into shared memory blocks; returns the blocks and their descriptions (name, shape, dtype) for the workers
+def share_arrays(arrays):
+    blocks, descriptions = [], dict()
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        blocks.append(block)
+        descriptions[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, descriptions
+
+
+# Attach a worker process to the shared arrays (the CSR matrix is built on the shared buffers without copying them)
+def attach_arrays(descriptions, shape):
+    global _shared
+    blocks = {name: shared_memory.SharedMemory(name=block_name) for name, (block_name, _, _) in descriptions.items()}
+    arrays = {name: np.ndarray(array_shape, dtype=np.dtype(dtype), buffer=blocks[name].buf) for name, (_, array_shape, dtype) in descriptions.items()}
+    X = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=shape, copy=False)
+    _shared = {"blocks": blocks, "X": X, "y": arrays["y"]}
+
+
+###############################################
+# Resamples
+###############################################
+
+# Training and test rows of a resample: bootstrap => rows drawn with replacement, tested on the rows not drawn (out of bag);
+# cv => fold of a repeated k-fold split (repeat = task // n_folds, the split of a repeat is the same for all its folds)
+def resample_rows(method, task, n_rows, seed_sequence, n_folds=10):
+    if method == "bootstrap":
+        rng = np.random.default_rng(seed_sequence)
+        train = rng.integers(0, n_rows, n_rows)
+        test = np.setdiff1d(np.arange(n_rows), train)
+    elif method == "cv":
+        order = np.random.default_rng(seed_sequence).permutation(n_rows)
+        folds = np.array_split(order, n_folds)
+        test = np.sort(folds[task % n_folds])
+        train = np.sort(np.concatenate([f for i, f in enumerate(folds) if i != task % n_folds]))
+    else:
+        raise ValueError(f"Unknown resampling method: {method}")
+    return train, test
+
+
+# Seed sequence of each task (cv: one per repeat, shared by the folds of the repeat)
+def task_seeds(method, n_tasks, seed, n_folds=10):
+    if method == "cv":
+        repeats = np.random.SeedSequence(seed).spawn(-(-n_tasks // n_folds))
+        return [repeats[task // n_folds] for task in range(n_tasks)]
+    return np.random.SeedSequence(seed).spawn(n_tasks)
+
+
+# Run one resample in a worker: fit(X_train, y_train, X_test, y_test, columns, seed) returns a dict of results
+def run_task(task, method, seed_sequence, fit, columns, n_folds):
+    X, y = _shared["X"], _shared["y"]
+    train, test = resample_rows(method, task, X.shape[0], seed_sequence, n_folds)
+    seed = int(seed_sequence.generate_state(1)[0])
+    return {"task": task, **fit(X[train], y[train], X[test], y[test], columns, seed)}
+
+
+###############################################
+# Model fits
+###############################################
+
+# Test metrics (mean absolute error, mean squared error, root mean squared error, R^2); NaN without test rows
+def metrics(y_test, y_pred):
+    if len(y_test) == 0:
+        return {"mae": np.nan, "mse": np.nan, "rmse": np.nan, "r2": np.nan}
+    mse = np.mean((y_test - y_pred) ** 2)
+    return {"mae": np.mean(np.abs(y_test - y_pred)), "mse": mse, "rmse": np.sqrt(mse), "r2": 1 - mse / np.var(y_test) if np.var(y_test) > 0 else np.nan}
+
+
+# OLS with intercept (least squares); coefficients of all columns and test metrics
+def fit_ols(X_train, y_train, X_test, y_test, columns, seed):
+    coef = np.linalg.lstsq(sparse.hstack([np.ones((X_train.shape[0], 1)), X_train]).toarray(), y_train, rcond=None)[0]
+    y_pred = coef[0] + X_test @ coef[1:]
+    return {"intercept": coef[0], **dict(zip(columns, coef[1:])), **metrics(y_test, y_pred)}
+
+
+# Fit a copy of an estimator with fit/predict (e.g. RandomForestRegressor, XGBRegressor; use functools.partial to pass it)
+# with the seed of the resample as random_state; test metrics
+def fit_estimator(X_train, y_train, X_test, y_test, columns, seed, estimator=None):
+    model = copy.deepcopy(estimator)
+    if "random_state" in model.get_params():
+        model.set_params(random_state=seed % 2**32)
+    model.fit(X_train, y_train)
+    return metrics(y_test, model.predict(X_test) if X_test.shape[0] else np.empty(0))
+
+
+###############################################
+# Engine
+###############################################
+
+# Name of a fit function (with the arguments of a functools.partial, e.g. the estimator)
+def fit_name(fit):
+    if isinstance(fit, functools.partial):
+        return f"{fit_name(fit.func)}({fit.args!r}, {fit.keywords!r})"
+    return f"{fit.__module__}.{fit.__qualname__}"
+
+
+# Key of a resampling configuration (a checkpoint file can only be continued with the same configuration)
+def resampling_key(matrix, fit, columns, method, seed, n_folds):
+    config = {"fit": fit_name(fit), "columns": columns, "method": method, "seed": seed, "n_folds": n_folds,
+              "shape": list(matrix.X.shape), "ids": hashlib.sha256("\n".join(matrix.ids).encode("utf-8")).hexdigest()}
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+# Results of finished tasks in a checkpoint file (JSON lines, the first line holds the configuration key)
+def read_checkpoint(checkpoint, key):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return dict()
+    with open(checkpoint, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines or lines[0].get("key") != key:
+        raise ValueError(f"Checkpoint {checkpoint} was written with another configuration, remove it to start again.")
+    return {r["task"]: r for r in lines[1:]}
+
+
+# Run bootstrap resamples (method="bootstrap") or repeated k-fold cross-validation (method="cv", n_resamples repeats of
+# n_folds folds) of fit on the columns of a model matrix (default: all columns); results are a DataFrame with one row per task
+def resample(matrix, fit=fit_ols, columns=None, method="bootstrap", n_resamples=1000, n_folds=10, seed=42, n_workers=None, checkpoint=None):
+    columns = list(matrix.columns) if columns is None else list(columns)
+    n_tasks = n_resamples * n_folds if method == "cv" else n_resamples
+    seeds = task_seeds(method, n_tasks, seed, n_folds)
+
+    key = resampling_key(matrix, fit, columns, method, seed, n_folds)
+    results = read_checkpoint(checkpoint, key)
+    todo = [task for task in range(n_tasks) if task not in results]
+    print(f"Running {len(todo)} of {n_tasks} resamples ({len(results)} in checkpoint).")
+
+    if todo:
+        X = select_columns(matrix, columns).tocsr()
+        blocks, descriptions = share_arrays({"data": X.data, "indices": X.indices, "indptr": X.indptr, "y": np.asarray(matrix.y, dtype=float)})
+        try:
+            if checkpoint is not None and not os.path.exists(checkpoint):
+                with open(checkpoint, "w", encoding="utf-8") as f:
+                    f.write(json.dumps({"key": key}) + "\n")
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=attach_arrays, initargs=(descriptions, X.shape)) as pool:
+                futures = [pool.submit(run_task, task, method, seeds[task], fit, columns, n_folds) for task in todo]
+                for i, future in enumerate(as_completed(futures)):
+                    result = {k: float(v) if isinstance(v, (np.floating, np.integer)) else v for k, v in future.result().items()}
+                    results[result["task"]] = result
+                    if checkpoint is not None:
+                        with open(checkpoint, "a", encoding="utf-8") as f:
+                            f.write(json.dumps(result) + "\n")
+                    if (i + 1) % 100 == 0:
+                        print(f"Finished {i + 1} of {len(todo)} resamples.")
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    return pd.DataFrame([results[task] for task in range(n_tasks)]).set_index("task")
+
+
+# Mean, standard deviation, and percentile interval of each result over the resamples (e.g. coefficients of party dummies)
+def confidence_intervals(results, level=0.95):
+    alpha = (1 - level) / 2
+    return pd.DataFrame({"mean": results.mean(), "std": results.std(), "lower": results.quantile(alpha), "upper": results.quantile(1 - alpha)})
@@ -0,0 +1,95 @@
+'''
+Functions to score the sentiment of ad texts with germansentiment in batches, in parallel, and with an on-disk cache
+'''
+
+import functools
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import torch
+from germansentiment import SentimentModel
+
+SENTIMENT_COLUMNS = ['sentiment_class', 'sentiment_positive', 'sentiment_negative', 'sentiment_neutral']
+
+# Sentiment model of the current process (loaded once per process and model name; _NOT_LOADED => no model loaded yet,
+# as None names the default model)
+_NOT_LOADED = object()
+_model = None
+_model_name = _NOT_LOADED
+
+
+# Hash of an ad text and the sentiment model used as cache key (None => default German model, hash of the text only)
+def text_hash(text, model_name=None):
+    key = text if model_name is None else model_name + "\0" + text
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Load the sentiment model (model_name: Hugging Face model, None => default German model) and limit the number of
+# torch threads of the current process
+def init_sentiment_model(torch_threads=None, model_name=None):
+    global _model, _model_name
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    if _model is None or model_name != _model_name:
+        _model = SentimentModel(model_name) if model_name is not None else SentimentModel()
+        _model_name = model_name
+    return _model
+
+
+# Predict sentiment class and probabilities for a batch of texts (with the model loaded for model_name)
+def predict_batch(texts, model_name=None):
+    model = init_sentiment_model(model_name=model_name)
+    classes, probabilities = model.predict_sentiment(list(texts), output_probabilities=True)
+    results = []
+    for sentiment_class, probs in zip(classes, probabilities):
+        probs = dict(probs)
+        results.append([sentiment_class, probs["positive"], probs["negative"], probs["neutral"]])
+    return results
+
+
+# Read cached sentiment scores (indexed by text hash, see text_hash)
+def read_sentiment_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return pd.DataFrame(columns=SENTIMENT_COLUMNS, index=pd.Index([], name="text_hash"))
+    cache = pd.read_csv(cache_path, encoding='utf-8', index_col="text_hash")
+    return cache[~cache.index.duplicated(keep="last")]
+
+
+# Append newly scored texts to the cache
+def write_sentiment_cache(cache_path, hashes, results):
+    if cache_path is None:
+        return
+    scores = pd.DataFrame(results, columns=SENTIMENT_COLUMNS, index=pd.Index(hashes, name="text_hash"))
+    scores.to_csv(cache_path, mode="a", header=not os.path.exists(cache_path), encoding='utf-8')
+
+
+# Score sentiment of ad texts; identical texts are scored once and only texts missing from the cache are scored
+# (scores of other models in the same cache file are not reused)
+def sentiment_scores(texts, batch_size=64, n_workers=1, torch_threads=None, cache_path=None, model_name=None):
+    texts = texts.astype(str)
+    hashes = texts.map(lambda text: text_hash(text, model_name))
+    cache = read_sentiment_cache(cache_path)
+
+    # Distinct texts not scored yet
+    new = pd.Series(texts.to_numpy(), index=hashes.to_numpy())
+    new = new[~new.index.duplicated() & ~new.index.isin(cache.index)]
+    batches = [new.iloc[i:i + batch_size] for i in range(0, len(new), batch_size)]
+    print(f"Scoring sentiment of {len(new)} new texts ({texts.nunique()} distinct, {len(texts)} ads).")
+
+    scored = []
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_sentiment_model, initargs=(torch_threads, model_name)) as pool:
+            for batch, results in zip(batches, pool.map(functools.partial(predict_batch, model_name=model_name), [b.tolist() for b in batches])):
+                write_sentiment_cache(cache_path, batch.index, results)
+                scored.append(pd.DataFrame(results, columns=SENTIMENT_COLUMNS, index=batch.index))
+    else:
+        init_sentiment_model(torch_threads, model_name)
+        for batch in batches:
+            results = predict_batch(batch.tolist(), model_name)
+            write_sentiment_cache(cache_path, batch.index, results)
+            scored.append(pd.DataFrame(results, columns=SENTIMENT_COLUMNS, index=batch.index))
+
+    scores = pd.concat([cache] + scored)
+    # Scores for each ad
+    return pd.DataFrame(scores.loc[hashes, SENTIMENT_COLUMNS].to_numpy(), columns=SENTIMENT_COLUMNS, index=texts.index).astype({c: float for c in SENTIMENT_COLUMNS[1:]})
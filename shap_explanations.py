@@ -0,0 +1,111 @@
+'''
+Functions to compute SHAP values of the tree models (RandomForest, XGBoost) in chunks across worker processes, optionally
+for a sample of ads stratified by party, and to cache them on disk as memory-mappable arrays keyed by the model hash
+'''
+
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import shap
+
+# Tree explainer of the current worker process
+_explainer = None
+
+
+###############################################
+# Sampling
+###############################################
+
+# Positions of a sample of about budget rows stratified by group (e.g. party); the budget is allocated proportionally
+# to the group sizes, but every group gets at least min_per_group rows (or all its rows if it is smaller)
+def stratified_sample(groups, budget, seed=42, min_per_group=50):
+    groups = pd.Series(np.asarray(groups))
+    if budget is None or budget >= len(groups):
+        return np.arange(len(groups))
+    rng = np.random.default_rng(seed)
+    sizes = groups.value_counts().sort_index()
+    allocation = np.minimum(sizes, np.maximum(np.floor(sizes / len(groups) * budget), min_per_group)).astype(int)
+    positions = [rng.choice(np.flatnonzero(groups.to_numpy() == group), n, replace=False) for group, n in allocation.items()]
+    return np.sort(np.concatenate(positions))
+
+
+###############################################
+# SHAP values
+###############################################
+
+# Create the tree explainer of a worker process (the model is sent once per worker, not with every chunk)
+def init_explainer(model):
+    global _explainer
+    _explainer = shap.TreeExplainer(model)
+
+
+# SHAP values of a chunk of rows (ads x features)
+def explain_chunk(X):
+    return np.asarray(_explainer.shap_values(X), dtype=np.float32)
+
+
+# Hash of a fitted model (pickled parameters and trees)
+def model_hash(model):
+    return hashlib.sha256(pickle.dumps(model)).hexdigest()[:16]
+
+
+# Hash of the explained rows (positions, values, and column names)
+def data_hash(X, positions):
+    sha256 = hashlib.sha256(np.asarray(positions, dtype=np.int64).tobytes())
+    sha256.update(np.ascontiguousarray(X.iloc[positions].to_numpy(dtype=np.float64)).tobytes())
+    sha256.update(json.dumps([str(c) for c in X.columns]).encode("utf-8"))
+    return sha256.hexdigest()[:16]
+
+
+# SHAP values of a tree model for the rows of X (DataFrame), optionally for a sample of about budget rows stratified by
+# groups (e.g. parties); returns the SHAP values (memory-mapped, ads x features), the explained rows, and metadata.
+# Values are cached in cache_folder as shap_<model hash>_<data hash>.npy (explained rows and metadata in .json)
+def shap_values(model, X, groups=None, budget=None, seed=42, chunk_size=1000, n_workers=None, cache_folder="shap_cache"):
+    positions = stratified_sample(groups if groups is not None else np.zeros(len(X)), budget, seed)
+    cache = os.path.join(cache_folder, f"shap_{model_hash(model)}_{data_hash(X, positions)}")
+    if os.path.exists(cache + ".json"):
+        return read_shap_values(cache, X)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    X_sample = X.iloc[positions]
+    values = np.lib.format.open_memmap(cache + ".npy", mode="w+", dtype=np.float32, shape=X_sample.shape)
+    chunks = [X_sample.iloc[i:i + chunk_size] for i in range(0, len(X_sample), chunk_size)]
+    print(f"Computing SHAP values of {len(X_sample)} ads in {len(chunks)} chunks.")
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_explainer, initargs=(model,)) as pool:
+        start = 0
+        for chunk_values in pool.map(explain_chunk, chunks):
+            values[start:start + len(chunk_values)] = chunk_values
+            start += len(chunk_values)
+    values.flush()
+    del values
+
+    # The metadata file is written last, so that an interrupted run is not read as a complete cache entry
+    expected_value = np.asarray(shap.TreeExplainer(model).expected_value, dtype=float).ravel().tolist()
+    with open(cache + ".json", "w", encoding="utf-8") as f:
+        json.dump({"positions": positions.tolist(), "columns": [str(c) for c in X.columns], "expected_value": expected_value}, f)
+    return read_shap_values(cache, X)
+
+
+# Cached SHAP values (memory-mapped), explained rows of X, and metadata (positions, columns, expected value)
+def read_shap_values(cache, X):
+    with open(cache + ".json", encoding="utf-8") as f:
+        meta = json.load(f)
+    return np.load(cache + ".npy", mmap_mode="r"), X.iloc[meta["positions"]], meta
+
+
+###############################################
+# Aggregates
+###############################################
+
+# Mean absolute SHAP value of each feature (features x groups, e.g. parties, and overall)
+def mean_abs_shap(values, columns, groups=None):
+    abs_values = pd.DataFrame(np.abs(values), columns=columns)
+    overall = abs_values.mean().rename("all")
+    if groups is None:
+        return overall.to_frame()
+    by_group = abs_values.groupby(np.asarray(groups)).mean().T
+    return pd.concat([by_group, overall], axis=1).sort_values("all", ascending=False)
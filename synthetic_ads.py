@@ -0,0 +1,201 @@
+"""
+A script to create synthetic raw Ad Library and Ad Targeting data, candidates, and exchange rates (same files and formats as the collected data).
+
+The raw data cannot be shared (Meta's ToS), synthetic ads allow to run and benchmark the pipeline offline, e.g.
+"python synthetic_ads.py 100000 --output Data/Germany".
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+# Age and gender buckets of the demographic distribution reported by the Ad Library
+DEMOGRAPHIC_AGES = ['13-17', '18-24', '25-34', '35-44', '45-54', '55-64', '65+', 'Unknown']
+DEMOGRAPHIC_GENDERS = ['female', 'male', 'unknown']
+# Lower bounds of the ranges reported by the Ad Library
+SPEND_BOUNDS = [0, 100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 1500, 2000, 2500, 3000, 3500, 4000, 4500, 5000, 10000, 15000, 20000, 25000, 30000]
+IMPRESSIONS_BOUNDS = [0, 1000, 2000, 3000, 4000, 5000, 6000, 7000, 8000, 9000, 10000, 15000, 20000, 25000, 30000, 35000, 40000, 45000, 50000,
+                      60000, 70000, 80000, 90000, 100000, 125000, 150000, 175000, 200000, 250000, 300000, 350000, 400000, 450000, 500000, 1000000]
+AUDIENCE_BOUNDS = [1000, 5000, 10000, 50000, 100000, 500000, 1000000]
+# Targeting categories and criteria of the Ad Targeting data
+TARGETING_CATEGORIES = {
+    "Interests": ["Politik", "Umweltschutz", "Fußball", "Familie", "Bildung", "Landwirtschaft", "Digitalisierung", "Klimawandel", "Wandern", "Musik"],
+    "Behaviors": ["Frequent Travelers", "Small business owners", "Facebook access (mobile): smartphones and tablets", "Technology early adopters"],
+    "Demographics": ["Parents (All)", "Newly engaged (6 months)", "Away from hometown", "Lives with family"],
+    "Job Titles": ["Lehrer", "Landwirt", "Krankenpfleger", "Unternehmer", "Polizist"],
+    "Employers": ["Deutsche Bahn", "Siemens", "Bundeswehr"],
+    "Education Schools": ["Universität Hamburg", "LMU München", "TU Berlin"],
+}
+TARGETING_GENDERS = ["All", "Men", "Women"]
+# Boolean targeting variables of the Ad Targeting data besides the include/exclude criteria
+TARGETING_FLAGS = ["include_custom_audience", "include_lookalike_audience", "exclude_custom_audience", "exclude_lookalike_audience"]
+# Parties (short and long name) and names of candidates
+PARTIES = [("CDU", "Christlich Demokratische Union Deutschlands"), ("CSU", "Christlich-Soziale Union in Bayern e.V."), ("SPD", "Sozialdemokratische Partei Deutschlands"),
+           ("AfD", "Alternative für Deutschland"), ("FDP", "Freie Demokratische Partei"), ("DIE LINKE", "DIE LINKE"), ("GRÜNE", "BÜNDNIS 90/DIE GRÜNEN"),
+           ("Volt", "Volt Deutschland"), ("FREIE WÄHLER", "FREIE WÄHLER")]
+FIRST_NAMES = ["Anna", "Karl-Heinz", "Jürgen", "Maria Luise", "Ali", "Eva", "Tim", "Katrin", "Stefan", "Ute", "Ömer", "Jens", "Sabine", "Lars"]
+SURNAMES = ["Müller", "Schmidt", "Schneider", "Fischer", "Weber", "Meyer", "Wagner", "Becker", "Schulz", "Hoffmann", "Koch", "Richter", "Wolf", "Neumann"]
+
+
+# Range strings (e.g. "{'lower_bound': '100', 'upper_bound': '199'}"), largest ranges and some ads only report a lower bound
+def synthetic_range_strings(rng, n_ads, bounds, p_open=0.01):
+    bounds = np.asarray(bounds)
+    index = rng.integers(0, len(bounds), size=n_ads)
+    lower = bounds[index]
+    upper = np.append(bounds[1:], bounds[-1] * 2)[index] - 1
+    open_ended = (index == len(bounds) - 1) | (rng.random(n_ads) < p_open)
+    return np.where(open_ended,
+                    [f"{{'lower_bound': '{l}'}}" for l in lower],
+                    [f"{{'lower_bound': '{l}', 'upper_bound': '{u}'}}" for l, u in zip(lower, upper)]).astype(object)
+
+
+# Raw demographic distribution strings (shares of age/gender buckets sum to one)
+def synthetic_demographic_strings(rng, n_ads, p_missing=0.01, p_automated=0.005):
+    buckets = [(age, gender) for age in DEMOGRAPHIC_AGES for gender in DEMOGRAPHIC_GENDERS]
+    distributions = []
+    for n in rng.integers(1, len(buckets) + 1, size=n_ads):
+        if rng.random() < p_automated:
+            distributions.append("[{'percentage': '1', 'age': 'All (Automated App Ads)', 'gender': 'All (Automated App Ads)'}]")
+            continue
+        lines = rng.choice(len(buckets), size=n, replace=False)
+        shares = rng.dirichlet(np.ones(n)).round(6)
+        distributions.append("[" + ", ".join("{'percentage': '%s', 'age': '%s', 'gender': '%s'}" % (p, *buckets[b]) for p, b in zip(shares, lines)) + "]")
+    distributions = np.array(distributions, dtype=object)
+    distributions[rng.random(n_ads) < p_missing] = np.nan
+    return distributions
+
+
+# Candidate list btw21 (numbered surnames keep candidate names unique)
+def synthetic_candidates(n_candidates=6000, seed=42):
+    rng = np.random.default_rng(seed)
+    parties = rng.integers(0, len(PARTIES), size=n_candidates)
+    return pd.DataFrame({
+        "Nachname": [f"{SURNAMES[s]}{i:05d}" for i, s in enumerate(rng.integers(0, len(SURNAMES), size=n_candidates))],
+        "Vornamen": rng.choice(FIRST_NAMES, size=n_candidates),
+        "Geschlecht": rng.choice(["m", "w"], size=n_candidates),
+        "Geburtsjahr": rng.integers(1940, 2000, size=n_candidates),
+        "Gruppenname": [PARTIES[p][0] for p in parties],
+        "GruppennameLang": [PARTIES[p][1] for p in parties],
+        "Gebietsnummer": rng.integers(1, 300, size=n_candidates),
+        "Kennzeichen": rng.choice(["Kreiswahlvorschlag", "Landesliste"], size=n_candidates),
+        "VerknKennzeichen": rng.choice(["Landesliste", None], size=n_candidates),
+        "VorpGewaehlt": rng.choice(["X", None], size=n_candidates, p=[0.1, 0.9]),
+        "GebietLandAbk": rng.choice(["BY", "BW", "NW", "NI", "HE", "BE"], size=n_candidates),
+        "Berufsschluessel": rng.integers(1, 100, size=n_candidates),
+    })
+
+
+# Exchange rates USD per EUR (Bundesbank format, "." on days without rate)
+def synthetic_exchange_rates(seed=42):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2021-05-01", "2021-12-31")
+    rates = [f"{r:.4f}".replace(".", ",") for r in 1.18 + rng.normal(0, 0.005, size=len(dates)).cumsum()]
+    rates = np.where(dates.weekday >= 5, ".", rates)
+    return pd.DataFrame({"date": dates.strftime("%Y-%m-%d"), "rate": rates, "comment": np.where(dates.weekday >= 5, "Kein Wert vorhanden", "")})
+
+
+# Raw Ad Library data (pages are run by candidates, party organizations, or other sponsors)
+def synthetic_raw_ads(n_ads, seed=42, candidates=None):
+    rng = np.random.default_rng(seed)
+    candidates = synthetic_candidates(seed=seed) if candidates is None else candidates
+    n_pages = max(n_ads // 20, 1)
+    page_ids = rng.integers(10**13, 10**15, size=n_pages)
+    page_names = np.where(rng.random(n_pages) < 0.6,
+                          (candidates["Vornamen"] + " " + candidates["Nachname"]).to_numpy()[rng.integers(0, len(candidates), size=n_pages)],
+                          np.array([f"{party} {city}" for party, _ in PARTIES for city in ["Berlin", "München", "Köln", "Kreisverband Harz"]] + ["Seite"] * 10,
+                                   dtype=object)[rng.integers(0, len(PARTIES) * 4 + 10, size=n_pages)])
+    pages = rng.integers(0, n_pages, size=n_ads)
+    start = pd.Timestamp("2021-06-01") + pd.to_timedelta(rng.integers(0, 118, size=n_ads), unit="D")
+    stop = start + pd.to_timedelta(rng.integers(0, 45, size=n_ads), unit="D")
+    platforms = np.array(["['facebook']", "['instagram']", "['facebook', 'instagram']"], dtype=object)
+    texts = np.array([f"['Am 26. September {party} wählen!\\n Mehr unter www.example.de/{i}']" for i in range(200) for party in ["SPD", "CDU", "GRÜNE", "FDP", "AfD", "DIE LINKE"]], dtype=object)
+
+    return pd.DataFrame({
+        "Unnamed: 0": np.arange(n_ads),
+        "id": rng.permutation(10**14 + np.arange(n_ads) * 100 + rng.integers(0, 100, size=n_ads)),
+        "ad_creation_time": (start - pd.to_timedelta(rng.integers(0, 3, size=n_ads), unit="D")).strftime("%Y-%m-%d"),
+        "ad_creative_bodies": texts[rng.integers(0, len(texts), size=n_ads)],
+        "ad_creative_link_captions": "['example.de']",
+        "ad_creative_link_titles": "['Jetzt informieren']",
+        "ad_creative_link_descriptions": "['Unser Programm für die Bundestagswahl']",
+        "ad_delivery_start_time": start.strftime("%Y-%m-%d"),
+        # Ads without end date are still active
+        "ad_delivery_stop_time": np.where(rng.random(n_ads) < 0.05, None, stop.strftime("%Y-%m-%d")),
+        "ad_snapshot_url": [f"https://www.facebook.com/ads/archive/render_ad/?id={i}" for i in range(n_ads)],
+        "bylines": np.where(rng.random(n_ads) < 0.5, None, page_names[pages]),
+        "currency": np.where(rng.random(n_ads) < 0.01, "USD", "EUR"),
+        "delivery_by_region": "[]",
+        "demographic_distribution": synthetic_demographic_strings(rng, n_ads),
+        "estimated_audience_size": synthetic_range_strings(rng, n_ads, AUDIENCE_BOUNDS, p_open=0.05),
+        "impressions": synthetic_range_strings(rng, n_ads, IMPRESSIONS_BOUNDS),
+        "languages": "['de']",
+        "page_id": page_ids[pages],
+        "page_name": page_names[pages],
+        "publisher_platforms": platforms[rng.integers(0, len(platforms), size=n_ads)],
+        "spend": synthetic_range_strings(rng, n_ads, SPEND_BOUNDS),
+    })
+
+
+# Raw include/exclude criteria (list of groups mapping criterion -> category, "[]" if no criteria are used; single_group
+# => a single group is sometimes not wrapped in a list, as for a few exclude values of the collected data)
+def synthetic_targeting_strings(rng, n_ads, p_used, max_groups=3, single_group=False):
+    categories = list(TARGETING_CATEGORIES)
+    strings = np.full(n_ads, "[]", dtype=object)
+    for i in np.flatnonzero(rng.random(n_ads) < p_used):
+        groups = []
+        for _ in range(rng.integers(1, max_groups + 1)):
+            group = dict()
+            for category in rng.choice(categories, size=rng.integers(1, 3), replace=False):
+                criteria = TARGETING_CATEGORIES[category]
+                for criterion in rng.choice(criteria, size=rng.integers(1, min(len(criteria), 4) + 1), replace=False):
+                    group[str(criterion)] = str(category)
+            groups.append(group)
+        strings[i] = str(groups[0] if single_group and len(groups) == 1 and rng.random() < 0.5 else groups).encode("unicode_escape").decode("ascii")
+    return strings
+
+
+# Raw Ad Targeting data (targeting and location files) of the given ads
+def synthetic_targeting(ids, seed=42):
+    rng = np.random.default_rng(seed)
+    n_ads = len(ids)
+    lower = rng.choice([13, 18, 18, 18, 25, 30, 35, 45, 55, 65], size=n_ads)
+    upper = np.maximum(lower, rng.choice([24, 34, 44, 54, 64, 65, 65, 65], size=n_ads))
+    targeting = pd.DataFrame({
+        "archive_id": ids,
+        "ds": "2021-10-01",
+        "age": [f"{l} - 65+" if u == 65 else f"{l} - {u}" for l, u in zip(lower, upper)],
+        "gender": rng.choice(TARGETING_GENDERS, size=n_ads, p=[0.8, 0.1, 0.1]),
+        "include": synthetic_targeting_strings(rng, n_ads, p_used=0.3),
+        "exclude": synthetic_targeting_strings(rng, n_ads, p_used=0.05, max_groups=1, single_group=True),
+    })
+    for flag in TARGETING_FLAGS:
+        targeting[flag] = rng.random(n_ads) < 0.1
+    location = pd.DataFrame({
+        "archive_id": ids,
+        "include_location": rng.choice(["Germany", "Bayern, Germany", "Berlin, Germany", "Hamburg, Germany"], size=n_ads),
+        "exclude_location": np.where(rng.random(n_ads) < 0.02, 1, np.nan),
+    })
+    return targeting, location
+
+
+# Write synthetic raw Ad Library, Ad Targeting, candidate, and exchange rate files to a data folder
+def write_synthetic_data(data_folder, n_ads, seed=42):
+    os.makedirs(data_folder, exist_ok=True)
+    candidates = synthetic_candidates(seed=seed)
+    ads = synthetic_raw_ads(n_ads, seed, candidates)
+    targeting, location = synthetic_targeting(ads["id"], seed)
+    candidates.to_csv(os.path.join(data_folder, "btw21_kandidaturen_utf8.csv"), sep=";", index=False)
+    synthetic_exchange_rates(seed).to_csv(os.path.join(data_folder, "exchange_rate_USDEUR.csv"), sep=";", index=False, header=False)
+    ads.to_csv(os.path.join(data_folder, "fb_ad_library_data_DE.csv"), index=False)
+    targeting.to_csv(os.path.join(data_folder, "fb_targeting_DE.csv"), index=False)
+    location.to_csv(os.path.join(data_folder, "fb_targeting_DE_location.csv"), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create synthetic raw Ad Library and Ad Targeting data.")
+    parser.add_argument("n_ads", type=int)
+    parser.add_argument("--output", default="synthetic_data", help="data folder (e.g. Data/Germany)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    write_synthetic_data(args.output, args.n_ads, args.seed)
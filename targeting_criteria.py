@@ -0,0 +1,108 @@
+'''
+Functions to parse the include/exclude targeting criteria of the Ad Targeting data
+'''
+
+import ast
+import json
+from collections import defaultdict
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+
+# Decode a raw include/exclude string into a python object (without eval)
+def decode_targeting(vals):
+    if not isinstance(vals, str) or vals == "nan":
+        return None
+    vals = bytes(vals, "utf-8").decode("unicode_escape")
+    try:
+        return ast.literal_eval(vals)
+    except (ValueError, SyntaxError):
+        return json.loads(vals)
+
+
+# Parse a raw include/exclude string once into a tuple of (category, criterion) pairs
+@lru_cache(maxsize=None)
+def parse_targeting(vals):
+    vals = decode_targeting(vals)
+    if not vals:
+        return ()
+    # Groups map criterion -> category; exclude is sometimes a single group instead of a list
+    groups = vals if isinstance(vals, list) else [vals]
+    return tuple((group[val], val) for group in groups for val in group)
+
+
+# Group the parsed criteria of a raw include/exclude string by category
+@lru_cache(maxsize=None)
+def group_targeting_criteria(vals):
+    cat_vals = defaultdict(list)
+    for category, val in parse_targeting(vals):
+        cat_vals[category].append(val)
+    return {category: tuple(criteria) for category, criteria in cat_vals.items()}
+
+
+# Extract targeting categories (and their criteria) used in a column
+def get_unique_categories(data, var):
+    unique_categories = defaultdict(set)
+    for vals in data[var].astype(str).unique():
+        for category, val in parse_targeting(vals):
+            unique_categories[category].add(val)
+    return unique_categories
+
+
+# Create column name of a targeting category (e.g. "Job Titles", "include" -> "job_titles_include")
+def targeting_column(category, var):
+    return category.replace(" ", "_").lower() + "_" + var
+
+
+# Count criteria per targeting category for each ad (sparse ads x categories matrix)
+def targeting_count_matrix(raw, var, categories):
+    codes, uniques = pd.factorize(raw.astype(str))
+    category_index = {category: i for i, category in enumerate(categories)}
+    rows, cols, counts = [], [], []
+    # Parse each distinct string only once
+    for i, vals in enumerate(uniques):
+        for category, criteria in group_targeting_criteria(vals).items():
+            rows.append(i)
+            cols.append(category_index[category])
+            counts.append(len(criteria))
+    counts = sparse.csr_matrix((counts, (rows, cols)), shape=(len(uniques), len(categories)), dtype=np.int64)
+    # Gather rows of distinct strings for all ads
+    return counts[codes], [targeting_column(category, var) for category in categories]
+
+
+# One-hot encode individual targeting criteria for each ad (sparse ads x vocabulary matrix)
+def targeting_criteria_matrix(raw, var):
+    codes, uniques = pd.factorize(raw.astype(str))
+    vocabulary = {}
+    rows, cols = [], []
+    for i, vals in enumerate(uniques):
+        for criterion in dict.fromkeys(parse_targeting(vals)):
+            rows.append(i)
+            cols.append(vocabulary.setdefault(criterion, len(vocabulary)))
+    onehot = sparse.csr_matrix((np.ones(len(rows), dtype=np.uint8), (rows, cols)), shape=(len(uniques), len(vocabulary)))
+    # Vocabulary entries are (category, criterion) pairs, column names follow targeting_column
+    vocabulary = [(targeting_column(category, var), criterion) for category, criterion in vocabulary]
+    return onehot[codes], vocabulary
+
+
+# Dense export of the category counts: <column>_use dummy and <column>_count for each targeting column
+def targeting_features_frame(counts, columns, index=None):
+    counts = counts.toarray()
+    features = dict()
+    for i, colname in enumerate(columns):
+        features[colname + "_use"] = (counts[:, i] > 0).astype(np.int64)
+        features[colname + "_count"] = counts[:, i]
+    return pd.DataFrame(features, index=index)
+
+
+# List-valued criteria columns per targeting category (NaN if the category is not used by an ad)
+def targeting_criteria_lists(raw, var, categories):
+    codes, uniques = pd.factorize(raw.astype(str))
+    grouped = [group_targeting_criteria(vals) for vals in uniques]
+    criteria_lists = dict()
+    for category in categories:
+        per_unique = pd.Series([list(g[category]) if category in g else np.nan for g in grouped], dtype=object)
+        criteria_lists[targeting_column(category, var)] = per_unique.take(codes).to_numpy()
+    return pd.DataFrame(criteria_lists, index=raw.index)